@@ -3,55 +3,922 @@ from autogen_agentchat.agents import AssistantAgent
 from autogen_agentchat.teams import RoundRobinGroupChat
 from autogen_agentchat.ui import Console
 from autogen_core import CancellationToken
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+from autogen_core.model_context import HeadAndTailChatCompletionContext
+from autogen_core.models import ChatCompletionClient, CreateResult, SystemMessage, UserMessage
+from autogen_ext.models.openai import AzureOpenAIChatCompletionClient, OpenAIChatCompletionClient
+from autogen_ext.models.replay import ReplayChatCompletionClient
+from autogen_agentchat.base import TaskResult, TerminatedException, TerminationCondition
 from autogen_agentchat.conditions import TextMentionTermination
-from autogen_agentchat.messages import TextMessage
+from autogen_agentchat.messages import BaseChatMessage, ModelClientStreamingChunkEvent, StopMessage, TextMessage
 import unidiff
-import glob
+import openai
+import tiktoken
+import math
 import argparse
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
+import hmac
+import http.server
 import os
 import re
 import json
+import subprocess
+import textwrap
+import threading
+import time
 from github import Github
 import requests
-from typing import Dict, List, Any, Tuple, Optional
+from typing import Callable, Dict, List, Any, Tuple, Optional
 
 ####################
 # GitHub definitions
 ####################
 
-# Get GitHub action inputs
-github_token = os.environ["INPUT_GITHUB_TOKEN"]
-repository = os.environ["GITHUB_REPOSITORY"]
-pr_number = int(os.environ["INPUT_PR_NUMBER"])
-openai_model = os.environ["OPENAI_MODEL"]
-repository = os.environ["GITHUB_REPOSITORY"]
+# Get GitHub action inputs; replay runs (--replay) need none of them
+github_token = os.environ.get("INPUT_GITHUB_TOKEN", "")
+repository = os.environ.get("GITHUB_REPOSITORY", "")
+# Falls back to the number in the pull_request event payload when not given
+pr_number = int(os.environ.get("INPUT_PR_NUMBER") or 0) or None
+openai_model = os.environ.get("OPENAI_MODEL", "")
+
+#######################
+# Review configuration
+#######################
+
+# Defaults for every configurable setting, overridden by the JSON config file
+DEFAULT_CONFIG: Dict[str, Any] = {
+    # gitignore-style path rules: "**" spans directories, a trailing "/" matches
+    # everything below a directory, and a leading "!" re-includes a path.
+    # Later rules win over earlier ones.
+    "include": ["**"],
+    "exclude": [
+        "*.mdx",
+        "*.py",
+        "*.lock",
+        # Vendored and generated content is never worth a review
+        "vendor/",
+        "third_party/",
+        "node_modules/",
+        "**/generated/",
+        "*.min.js",
+        "*.min.css",
+        "*.map",
+    ],
+    # Threads used for blocking GitHub API calls, so they overlap with model requests
+    "github_io_workers": 4,
+    # USD per million tokens, matched against the model name by longest prefix
+    "model_prices": {
+        "gpt-4o-mini": {"prompt": 0.15, "cached_prompt": 0.075, "completion": 0.60},
+        "gpt-4o": {"prompt": 2.50, "cached_prompt": 1.25, "completion": 10.00},
+        "gpt-4.1-mini": {"prompt": 0.40, "cached_prompt": 0.10, "completion": 1.60},
+        "gpt-4.1": {"prompt": 2.00, "cached_prompt": 0.50, "completion": 8.00},
+    },
+    # Deities taking part in the review, in speaking order; null means the whole pantheon
+    "roster": None,
+    # Pre-flight limits, checked after the diff is parsed and before any model call
+    "budget": {
+        "max_cost_usd": 5.0,
+        "max_model_calls": 1300,
+        "max_minutes": 60,
+        # What to do when the plan exceeds a limit: "sample" chunks, "narrow" the
+        # roster to core_roster first, or "abort" with an explanatory PR comment
+        "action": "sample",
+        "core_roster": ["Apollo", "Hermes", "Hephaestus", "Atropos"],
+        # Assumptions used to project the cost of a run
+        "expected_completion_tokens": 350,
+        "seconds_per_call": 6.0,
+    },
+    # Chunks are reviewed most valuable first, and the review stops gracefully
+    # when the time or token budget of the run is spent
+    "schedule": {
+        # e.g. the job's timeout-minutes, minus setup time
+        "time_budget_minutes": None,
+        "token_budget": None,
+        # Time kept back for posting the comments gathered so far
+        "reserve_minutes": 2,
+        # Score = file type weight + best matching path weight
+        #         + added_line_weight per added line (up to 50) + code_block_weight
+        "file_type_weights": {".md": 3.0, ".rst": 3.0, ".adoc": 3.0, ".txt": 1.0},
+        "path_weights": {
+            "**/getting-started/": 5.0,
+            "**/quickstart/": 5.0,
+            "**/tutorials/": 3.0,
+            "README.md": 3.0,
+            "**/index.md": 2.0,
+        },
+        "added_line_weight": 0.05,
+        "code_block_weight": 2.0,
+    },
+    # Chunks larger than max_tokens (e.g. a newly added reference page) are
+    # split into windows, preferably at markdown headings, and each window is
+    # reviewed on its own. A window also shows the last overlap_lines lines of
+    # the previous one as context, but comments there are left to the window
+    # that owns them.
+    "windows": {
+        "max_tokens": 4000,
+        "overlap_lines": 5,
+    },
+    # Identical or near-identical chunks (e.g. a renamed term across many pages)
+    # are reviewed once and their comments copied to every matching location
+    "dedup": {
+        "enabled": True,
+        # Estimated Jaccard similarity of the chunks' lines above which they are grouped
+        "near_duplicate_threshold": 0.9,
+        # Pure additions with fewer word trigrams than this (e.g. a lone heading) are never grouped
+        "min_shingles": 12,
+    },
+    # Reuse a deity's earlier review of a similar chunk (e.g. one that differs
+    # only in whitespace, a version number or line wrapping) from past runs.
+    # Similarity is the cosine of local hashed word n-gram embeddings.
+    "semantic_cache": {
+        "enabled": False,
+        "path": ".pantheon-cache/reviews.json",
+        "similarity_threshold": 0.95,
+        # Least recently used entries are evicted beyond this many
+        "max_entries": 2000,
+    },
+    # Bounded model context of each agent: the task plus this many recent replies.
+    # Atropos, speaking last, needs to see every other deity's reply.
+    "agent_context": {
+        "tail_messages": 12,
+    },
+    # A chunk's review ends once every deity on the roster has replied with a
+    # valid JSON review, or after len(roster) + extra_turns turns at most
+    "termination": {
+        "extra_turns": 0,
+    },
+    # Stream model output and post each inline comment as soon as its JSON
+    # object is complete, instead of waiting for the whole chunk's review
+    "streaming": {
+        "enabled": False,
+    },
+    # Model backends by name; "default" serves every deity not mapped in
+    # deity_backends. Types are openai, azure, openai_compatible (any server
+    # with an OpenAI-style API at base_url, such as vLLM or llama.cpp) and
+    # stub (canned replies, no network). API keys are read from the
+    # environment variable named by api_key_env, never from this file.
+    "backends": {
+        "default": {"type": "openai"},
+    },
+    # e.g. {"Iris": "local", "Hephaestus": "local"}
+    "deity_backends": {},
+    # Drop a review once a newer push has moved the PR head; the run for the
+    # newer head reviews it instead. The head is checked before the review,
+    # at most every check_seconds during it, and before posting.
+    "coalesce": {
+        "enabled": True,
+        "check_seconds": 30,
+    },
+    # Index of the documentation in the checkout: how each term is spelled,
+    # heading anchors and the link graph. Demeter and Heracles are given the
+    # slices relevant to each chunk. Pages are re-indexed only when they change.
+    "docs_index": {
+        "enabled": False,
+        "path": ".pantheon-cache/docs-index.json",
+        "include": ["*.md", "*.mdx"],
+        "exclude": ["node_modules/", "vendor/", "third_party/"],
+        "max_terms": 10,
+        "max_links": 8,
+    },
+    # When each documentation page (as matched by docs_index) and the code it
+    # mentions last changed, read from the git history of the checkout. Chronos
+    # is given the facts about the page under review. Needs fetch-depth: 0.
+    "staleness": {
+        "enabled": False,
+        "path": ".pantheon-cache/staleness.json",
+        "max_facts": 8,
+    },
+    # One PR-level summary comment, reduced from per-chunk findings per file,
+    # then per directory, then for the whole PR. Each model call merges at
+    # most fan_in compact digests, so no prompt grows with the PR's size.
+    "summary": {
+        "enabled": False,
+        "deity": "Atropos",
+        "fan_in": 8,
+        "max_findings": 6,
+        "max_concurrent_merges": 4,
+    },
+    # Comments carry a hidden marker. With incremental posting, a run skips
+    # comments already on the PR and minimizes earlier comments within the
+    # lines and deities it reviewed that it no longer makes.
+    "posting": {
+        "incremental": True,
+    },
+    # Resident review server (--serve, --queue-dir)
+    "server": {
+        # PR reviews running at the same time
+        "workers": 2,
+        # Events waiting beyond this many are refused with HTTP 503
+        "queue_size": 100,
+        "actions": ["opened", "synchronize", "reopened"],
+        # Environment variable holding the webhook secret
+        "secret_env": "WEBHOOK_SECRET",
+        "poll_seconds": 1.0,
+    },
+    # Archive of the run (event, diff, model calls, GitHub calls) that
+    # --replay can re-run offline; written only when a path is set
+    "recording": {
+        "path": None,
+    },
+    # Per-run latency, token and cost breakdown
+    "telemetry": {
+        "summary_path": "pantheon-telemetry.json",
+        # OTLP/JSON trace file, written only when a path is set
+        "trace_path": None,
+        # Append a short table to the job summary when running in Actions
+        "step_summary": True,
+    },
+}
+
+# Config merger
+def merge_config(base: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    """Recursively merge config overrides into a copy of the base config."""
+    merged = dict(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+# Config loader
+def load_config(config_path: Optional[str] = None) -> Dict[str, Any]:
+    """Load the review configuration, falling back to the defaults when no file exists."""
+    config_path = config_path or os.environ.get("INPUT_CONFIG_PATH") or ".github/pantheon.json"
+
+    if not os.path.isfile(config_path):
+        return merge_config(DEFAULT_CONFIG, {})
+
+    with open(config_path, encoding="utf-8") as f:
+        overrides = json.load(f)
+    print(f"Loaded review configuration from {config_path}")
+
+    return merge_config(DEFAULT_CONFIG, overrides)
+
+# gitignore-style glob translator
+def glob_to_regex(pattern: str) -> str:
+    """Translate one gitignore-style glob into a regular expression over repo-relative paths."""
+    anchored = "/" in pattern.rstrip("/")
+    pattern = pattern.strip("/")
+
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            regex += f"[{body.replace(chr(92), chr(92) * 2)}]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+
+    # Unanchored patterns match at any depth, and a matched directory covers its contents
+    if not anchored:
+        regex = "(?:.*/)?" + regex
+    return regex + "(?:/.*)?"
+
+# Path matcher compiler
+def compile_path_matcher(patterns: List[str]) -> Callable[[str], bool]:
+    """
+    Compile gitignore-style patterns into a single matcher.
+
+    All rules are folded into one regular expression, in reverse order, so the
+    first alternative that matches is the last matching rule. Its group name
+    tells whether that rule was a negation.
+    """
+    alternatives = []
+    negated = {}
+    for index, pattern in enumerate(reversed(patterns)):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            continue
+        group = f"r{index}"
+        negated[group] = pattern.startswith("!")
+        alternatives.append(f"(?P<{group}>{glob_to_regex(pattern.lstrip('!'))})")
+
+    if not alternatives:
+        return lambda path: False
+
+    matcher = re.compile("|".join(alternatives))
+
+    def matches(path: str) -> bool:
+        match = matcher.fullmatch(path)
+        return match is not None and not negated[match.lastgroup]
+
+    return matches
+
+# Path filter builder
+def build_path_filter(include_patterns: List[str], exclude_patterns: List[str]) -> Callable[[str], bool]:
+    """Return a predicate that selects paths matching the include rules and none of the exclude rules."""
+    is_included = compile_path_matcher(include_patterns)
+    is_excluded = compile_path_matcher(exclude_patterns)
+    return lambda path: is_included(path) and not is_excluded(path)
+
+################
+# Run telemetry
+################
+
+# Telemetry collector builder
+def new_telemetry() -> Dict[str, Any]:
+    """
+    Start collecting the telemetry of one review: its spans, in the order they
+    finished, and the prompt tokens sent and served from the provider's cache.
+    """
+    return {
+        'trace_id': os.urandom(16).hex(),
+        'spans': [],
+        'prompt_cache': {"prompt_tokens": 0, "cached_tokens": 0},
+    }
+
+# The collector of the review running in this context. A single run uses the
+# default one; server workers each set their own, so concurrent reviews do not mix.
+current_telemetry: contextvars.ContextVar = contextvars.ContextVar("current_telemetry", default=new_telemetry())
+current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+# Span starter
+def start_span(name: str, kind: str, **attributes) -> Dict[str, Any]:
+    """Start a span under the currently active one. Kinds are stage, hunk, model and github."""
+    parent = current_span.get()
+    return {
+        'span_id': os.urandom(8).hex(),
+        'parent_id': parent['span_id'] if parent else None,
+        'name': name,
+        'kind': kind,
+        'start': time.time(),
+        'end': None,
+        'status': 'ok',
+        'attributes': attributes
+    }
+
+# Span finisher
+def finish_span(span: Dict[str, Any], status: str = 'ok') -> None:
+    """Close a span and add it to the review's telemetry."""
+    span['end'] = time.time()
+    span['status'] = status
+    current_telemetry.get()['spans'].append(span)
+
+# Span context manager
+@contextlib.contextmanager
+def telemetry_span(name: str, kind: str, **attributes):
+    """Record the enclosed block as a span and make it the parent of spans started inside it."""
+    span = start_span(name, kind, **attributes)
+    token = current_span.set(span)
+    status = 'ok'
+    try:
+        yield span
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        current_span.reset(token)
+        finish_span(span, status)
+
+# Model usage recorder
+def record_model_usage(span: Dict[str, Any], result: CreateResult) -> None:
+    """Copy a model call's token usage onto its span."""
+    span['attributes']['prompt_tokens'] = result.usage.prompt_tokens
+    span['attributes']['completion_tokens'] = result.usage.completion_tokens
+
+# Instrumented model client
+class InstrumentedChatCompletionClient(ChatCompletionClient):
+    """Model client wrapper that records a telemetry span for every call one deity makes."""
+
+    def __init__(self, inner: ChatCompletionClient, deity: str, model: str) -> None:
+        self._inner = inner
+        self._deity = deity
+        self._model = model
+
+    async def create(self, messages, **kwargs) -> CreateResult:
+        with telemetry_span(f"{self._deity} model call", "model", deity=self._deity, model=self._model) as span:
+            result = await self._inner.create(messages, **kwargs)
+            record_model_usage(span, result)
+            record_model_call(self._deity, messages, result)
+            return result
+
+    async def create_stream(self, messages, **kwargs):
+        # Generators may resume in another context, so this span is not made current
+        span = start_span(f"{self._deity} model call", "model", deity=self._deity, model=self._model)
+        status = 'error'
+        try:
+            async for item in self._inner.create_stream(messages, **kwargs):
+                if isinstance(item, CreateResult):
+                    record_model_usage(span, item)
+                    record_model_call(self._deity, messages, item)
+                yield item
+            status = 'ok'
+        finally:
+            finish_span(span, status)
+
+    async def close(self) -> None:
+        await self._inner.close()
+
+    def actual_usage(self):
+        return self._inner.actual_usage()
+
+    def total_usage(self):
+        return self._inner.total_usage()
+
+    def count_tokens(self, messages, **kwargs) -> int:
+        return self._inner.count_tokens(messages, **kwargs)
+
+    def remaining_tokens(self, messages, **kwargs) -> int:
+        return self._inner.remaining_tokens(messages, **kwargs)
+
+    @property
+    def capabilities(self):
+        return self._inner.capabilities
+
+    @property
+    def model_info(self):
+        return self._inner.model_info
+
+# Model price lookup
+def get_model_price(model_prices: Dict[str, Dict[str, float]], model: str) -> Dict[str, float]:
+    """Return the per-million-token prices for a model, matching its name by longest prefix."""
+    matches = [name for name in model_prices if model.startswith(name)]
+    if not matches:
+        return {"prompt": 0.0, "cached_prompt": 0.0, "completion": 0.0}
+    return model_prices[max(matches, key=len)]
+
+# Model call cost calculator
+def get_model_call_cost(model_prices: Dict[str, Dict[str, float]], attributes: Dict[str, Any]) -> float:
+    """Estimate the USD cost of one model call from the token counts on its span."""
+    price = get_model_price(model_prices, attributes.get('model', ''))
+    cached = attributes.get('cached_tokens', 0)
+    uncached = attributes.get('prompt_tokens', 0) - cached
+    return (uncached * price['prompt'] + cached * price['cached_prompt']
+            + attributes.get('completion_tokens', 0) * price['completion']) / 1_000_000
+
+# Telemetry summarizer
+def build_telemetry_summary(telemetry: Dict[str, Any], model_prices: Dict[str, Dict[str, float]]) -> Dict[str, Any]:
+    """Aggregate a review's spans into totals and per-stage, per-deity, per-hunk and per-API breakdowns."""
+    totals = {'model_calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0,
+              'retries': 0, 'model_seconds': 0.0, 'cost_usd': 0.0,
+              'github_calls': 0, 'github_errors': 0, 'github_seconds': 0.0}
+    stages, deities, hunks, github_calls = {}, {}, [], {}
+
+    for span in telemetry['spans']:
+        seconds = span['end'] - span['start']
+        attributes = span['attributes']
+
+        if span['kind'] == 'stage':
+            stages[span['name']] = stages.get(span['name'], 0.0) + seconds
+
+        elif span['kind'] == 'hunk':
+            hunks.append({'seconds': seconds, **attributes})
+
+        elif span['kind'] == 'model':
+            cost = get_model_call_cost(model_prices, attributes)
+            deity = deities.setdefault(attributes['deity'], {
+                'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0,
+                'retries': 0, 'seconds': 0.0, 'cost_usd': 0.0})
+            deity['calls'] += 1
+            deity['seconds'] += seconds
+            deity['cost_usd'] += cost
+            deity['retries'] += max(attributes.get('http_requests', 1) - 1, 0)
+            for key in ('prompt_tokens', 'cached_tokens', 'completion_tokens'):
+                deity[key] += attributes.get(key, 0)
+
+            totals['model_calls'] += 1
+            totals['model_seconds'] += seconds
+            totals['cost_usd'] += cost
+            totals['retries'] += max(attributes.get('http_requests', 1) - 1, 0)
+            for key in ('prompt_tokens', 'cached_tokens', 'completion_tokens'):
+                totals[key] += attributes.get(key, 0)
+
+        elif span['kind'] == 'github':
+            call = github_calls.setdefault(span['name'], {'calls': 0, 'errors': 0, 'seconds': 0.0})
+            call['calls'] += 1
+            call['seconds'] += seconds
+            call['errors'] += span['status'] == 'error'
+            totals['github_calls'] += 1
+            totals['github_seconds'] += seconds
+            totals['github_errors'] += span['status'] == 'error'
+
+    started = min((span['start'] for span in telemetry['spans']), default=time.time())
+    finished = max((span['end'] for span in telemetry['spans']), default=started)
+    return {
+        'trace_id': telemetry['trace_id'],
+        'duration_seconds': finished - started,
+        'totals': totals,
+        'stages': stages,
+        'deities': deities,
+        'hunks': hunks,
+        'github': github_calls
+    }
+
+# OTLP attribute encoder
+def to_otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Encode span attributes as OTLP/JSON key-value pairs."""
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            encoded.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            encoded.append({'key': key, 'value': {'doubleValue': value}})
+        elif value is not None:
+            encoded.append({'key': key, 'value': {'stringValue': str(value)}})
+    return encoded
+
+# OTLP trace builder
+def build_otlp_trace(telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    """Render a review's spans as an OTLP/JSON trace that OpenTelemetry collectors can ingest."""
+    spans = []
+    for span in telemetry['spans']:
+        otlp_span = {
+            'traceId': telemetry['trace_id'],
+            'spanId': span['span_id'],
+            'name': span['name'],
+            # Calls to GitHub and the model provider are client spans, the rest are internal
+            'kind': 3 if span['kind'] in ('model', 'github') else 1,
+            'startTimeUnixNano': str(int(span['start'] * 1e9)),
+            'endTimeUnixNano': str(int(span['end'] * 1e9)),
+            'attributes': to_otlp_attributes({'pantheon.kind': span['kind'], **span['attributes']}),
+            'status': {'code': 2 if span['status'] == 'error' else 1}
+        }
+        if span['parent_id']:
+            otlp_span['parentSpanId'] = span['parent_id']
+        spans.append(otlp_span)
+
+    return {'resourceSpans': [{
+        'resource': {'attributes': to_otlp_attributes({'service.name': 'pantheon-pr-reviewer'})},
+        'scopeSpans': [{'scope': {'name': 'pantheon_pr_reviewer'}, 'spans': spans}]
+    }]}
+
+# Step summary table builder
+def format_telemetry_table(summary: Dict[str, Any]) -> str:
+    """Format the telemetry summary as a short Markdown report for the job summary."""
+    totals = summary['totals']
+    lines = [
+        "### Pantheon review telemetry",
+        "",
+        f"{summary['duration_seconds']:.1f}s total, {totals['model_calls']} model calls "
+        f"({totals['model_seconds']:.1f}s), {totals['github_calls']} GitHub calls "
+        f"({totals['github_seconds']:.1f}s), estimated cost ${totals['cost_usd']:.4f}",
+        "",
+        "| Deity | Calls | Prompt tokens | Cached | Completion tokens | Retries | Seconds | Cost (USD) |",
+        "|---|---|---|---|---|---|---|---|",
+    ]
+    for name, deity in sorted(summary['deities'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append(f"| {name} | {deity['calls']} | {deity['prompt_tokens']} | {deity['cached_tokens']} | "
+                     f"{deity['completion_tokens']} | {deity['retries']} | {deity['seconds']:.1f} | "
+                     f"{deity['cost_usd']:.4f} |")
+    lines += ["", "| Stage | Seconds |", "|---|---|"]
+    for name, seconds in summary['stages'].items():
+        lines.append(f"| {name} | {seconds:.1f} |")
+    return "\n".join(lines) + "\n"
+
+# Telemetry file namer
+def suffix_path(path: str, suffix: str) -> str:
+    """Insert a suffix before a path's extension, e.g. telemetry.json -> telemetry-pr7.json."""
+    if not suffix:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}-{suffix}{extension}"
+
+# Telemetry exporter
+def export_telemetry(config: Dict[str, Any], telemetry: Optional[Dict[str, Any]] = None,
+                     suffix: str = "") -> Dict[str, Any]:
+    """
+    Write the JSON summary, the optional trace file and the job summary table of
+    a review, by default the one running in this context. A suffix keeps the
+    files of concurrent reviews apart.
+    """
+    telemetry_config = config["telemetry"]
+    telemetry = telemetry or current_telemetry.get()
+    summary = build_telemetry_summary(telemetry, config["model_prices"])
+
+    if telemetry_config.get("summary_path"):
+        summary_path = suffix_path(telemetry_config["summary_path"], suffix)
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Wrote telemetry summary to {summary_path}")
+
+    if telemetry_config.get("trace_path"):
+        trace_path = suffix_path(telemetry_config["trace_path"], suffix)
+        with open(trace_path, "w", encoding="utf-8") as f:
+            json.dump(build_otlp_trace(telemetry), f)
+        print(f"Wrote telemetry trace to {trace_path}")
+
+    step_summary_path = os.environ.get("GITHUB_STEP_SUMMARY")
+    if telemetry_config.get("step_summary") and step_summary_path:
+        with open(step_summary_path, "a", encoding="utf-8") as f:
+            f.write(format_telemetry_table(summary))
+
+    return summary
+
+###########################
+# Run recording and replay
+###########################
+
+# Archive of the current run, filled in only when recording is enabled
+run_recording: Optional[Dict[str, Any]] = None
+
+# Recording starter
+def start_recording(config: Dict[str, Any]) -> None:
+    """Start an archive of this run, holding everything replay_recording needs."""
+    global run_recording
+    run_recording = {
+        'config': config,
+        # Chunk windows depend on the tokenizer, so the windows themselves are
+        # recorded; the model is kept for archives from before they were
+        'model': get_backend_model(config["backends"]["default"]),
+        'windows': None,
+        'event': load_event_payload(),
+        'pr_details': None,
+        'diff': None,
+        'chunks': [],
+        'model_calls': [],
+        'github_calls': [],
+    }
+
+# Recording appender
+def record_run(key: str, value: Any) -> None:
+    """Add a value to the run archive, if one is being recorded."""
+    if run_recording is None:
+        return
+    if isinstance(run_recording[key], list):
+        run_recording[key].append(value)
+    else:
+        run_recording[key] = value
+
+# Model call recorder
+def record_model_call(deity: str, messages: Any, result: CreateResult) -> None:
+    """Add one model request and its response to the run archive."""
+    if run_recording is None:
+        return
+    record_run('model_calls', {
+        'deity': deity,
+        'request': [message.model_dump(mode="json") for message in messages],
+        'response': result.model_dump(mode="json"),
+    })
+
+# PR details recorder
+def record_pr_details(pr_details: Dict[str, Any]) -> None:
+    """Add the PR details to the run archive, leaving out the token and API objects."""
+    record_run('pr_details', {key: value for key, value in pr_details.items()
+                              if key not in ('repo_obj', 'pr_obj', 'github_token')})
+
+# Recording writer
+def save_recording(path: str) -> None:
+    """Write the run archive to disk."""
+    if run_recording is None:
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(run_recording, f, indent=2, default=str)
+    print(f"Wrote run recording to {path}")
+
+# Local stand-in for the GitHub API
+class LocalGitHub:
+    """Plays both the repository and the pull request object, keeping every write instead of sending it."""
+
+    def __init__(self) -> None:
+        self.calls: List[Dict[str, Any]] = []
+
+    def get_commit(self, sha: str) -> Any:
+        return type("Commit", (), {"sha": sha})()
+
+    def create_review(self, commit: Any, comments: List[Dict], event: str) -> None:
+        self.calls.append({'call': 'create_review', 'commit': commit.sha, 'event': event, 'comments': comments})
+
+    def create_issue_comment(self, body: str) -> None:
+        self.calls.append({'call': 'create_issue_comment', 'body': body})
+
+# Run replayer
+def replay_recording(archive_path: str) -> List[Dict[str, Any]]:
+    """
+    Re-run diff parsing, reply parsing and comment posting from a run archive,
+    over the chunk windows the recorded run reviewed.
+
+    Posting goes to a LocalGitHub, so this takes seconds and needs no network
+    access or credentials. Returns the GitHub writes the recorded run would
+    make with the current code.
+    """
+    with open(archive_path, encoding="utf-8") as f:
+        archive = json.load(f)
+    config = merge_config(DEFAULT_CONFIG, archive['config'])
+
+    local_github = LocalGitHub()
+    pr_details = dict(archive['pr_details'], repo_obj=local_github, pr_obj=local_github, github_token=None,
+                      has_checkout=False)
+
+    position_index = {}
+    parsed_files = parse_diff(archive['diff'],
+                              exclude_patterns=config["exclude"],
+                              include_patterns=config["include"],
+                              position_index=position_index)
+    # Replay the windows the run reviewed; re-splitting could cut them differently
+    # when the tokenizer is not the one the run had
+    if archive.get('windows') is not None:
+        parsed_files = archive['windows']
+    else:
+        parsed_files = split_oversized_chunks(parsed_files, config["windows"],
+                                              archive.get('model') or get_backend_model(config["backends"]["default"]))
+    parsed_files = group_duplicate_chunks(parsed_files, config["dedup"])
+    files_by_chunk = {(file_data['to'], file_data['chunk']['content']): file_data for file_data in parsed_files}
+
+    inline_reviews = []
+    for recorded in archive['chunks']:
+        file_data = files_by_chunk.get((recorded['file'], recorded['chunk']))
+        if file_data is None:
+            print(f"⚠️ Recorded chunk {recorded['chunk']} of {recorded['file']} is not in the re-parsed diff")
+            continue
+
+        task_result = TaskResult(messages=[TextMessage(source=message['source'], content=message['content'])
+                                           for message in recorded['messages']])
+        file_inline_reviews, file_general_reviews = parse_task_result_for_reviews(task_result)
+        file_inline_reviews = drop_overlap_comments(file_data['chunk'], file_inline_reviews)
+        file_inline_reviews, file_general_reviews = fan_out_duplicate_comments(
+            file_data, file_inline_reviews, file_general_reviews)
+        post_general_comments(pr_details, file_general_reviews)
+        inline_reviews.extend(file_inline_reviews)
+
+    post_comments_to_pr(pr_details, inline_reviews, [], position_index)
+    return local_github.calls
 
 ###################################
 # AutoGen model client definitions
 ###################################
 
-# Create an OpenAI model client
-model_client = OpenAIChatCompletionClient(
-    model=openai_model,
+# Model request counter
+async def record_model_request(request: Any) -> None:
+    """Count HTTP attempts on the active model call span, so client-side retries show up."""
+    span = current_span.get()
+    if span and span['kind'] == 'model':
+        span['attributes']['http_requests'] = span['attributes'].get('http_requests', 0) + 1
+
+# Prompt cache usage recorder
+async def record_prompt_cache_usage(response: Any) -> None:
+    """Record cached prompt tokens, which autogen's usage accounting does not surface."""
+    if not response.request.url.path.endswith("/chat/completions"):
+        return
+    if "application/json" not in response.headers.get("content-type", ""):
+        return
+
+    await response.aread()
+    usage = response.json().get("usage") or {}
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    # Model clients are shared, but each response is read in the context of the review that sent it
+    prompt_cache_stats = current_telemetry.get()['prompt_cache']
+    prompt_cache_stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+    prompt_cache_stats["cached_tokens"] += cached_tokens
+
+    span = current_span.get()
+    if span and span['kind'] == 'model':
+        span['attributes']['cached_tokens'] = span['attributes'].get('cached_tokens', 0) + cached_tokens
+
+# Model info assumed for OpenAI-compatible servers, whose model names autogen does not know
+OPENAI_COMPATIBLE_MODEL_INFO = {
+    "vision": False,
+    "function_calling": False,
+    "json_output": True,
+    "structured_output": False,
+    "family": "unknown",
+}
+
+# Reply of the stub backend when none is configured: a valid, empty review
+STUB_REPLY = json.dumps({"inlineReviews": [], "generalReviews": []})
+
+# Deterministic offline model client
+class StubChatCompletionClient(ReplayChatCompletionClient):
+    """Replay client that cycles through its canned replies instead of running out."""
+
+    def _rewind(self) -> None:
+        if self._current_index >= len(self.chat_completions):
+            self._current_index = 0
+
+    async def create(self, messages, **kwargs) -> CreateResult:
+        self._rewind()
+        return await super().create(messages, **kwargs)
+
+    async def create_stream(self, messages, **kwargs):
+        self._rewind()
+        async for item in super().create_stream(messages, **kwargs):
+            yield item
+
+# Model API key reader
+def get_backend_api_key(backend: Dict[str, Any], default_env: Optional[str]) -> Optional[str]:
+    """Read a backend's API key from the environment variable it names."""
+    env_name = backend.get("api_key_env", default_env)
+    return os.environ.get(env_name) if env_name else None
+
+# Model name of a backend
+def get_backend_model(backend: Dict[str, Any]) -> str:
+    """Return the model a backend serves, defaulting to the OPENAI_MODEL input."""
+    return backend.get("model") or openai_model
+
+# HTTP client with the prompt cache and retry hooks
+def create_http_client() -> Any:
+    # openai's own HTTP client class, so its timeouts and connection limits are kept
+    return openai.DefaultAsyncHttpxClient(event_hooks={
+        "request": [record_model_request],
+        "response": [record_prompt_cache_usage],
+    })
+
+# OpenAI backend
+def create_openai_client(backend: Dict[str, Any]) -> ChatCompletionClient:
     # api_key is taken from GitHub repository secret variable OPENAI_API_KEY
-)
+    return OpenAIChatCompletionClient(
+        model=get_backend_model(backend),
+        api_key=get_backend_api_key(backend, "OPENAI_API_KEY"),
+        http_client=create_http_client(),
+    )
 
-# Create an Gemini model client
-#model_client = OpenAIChatCompletionClient(
-#    model="gemini-1.5-flash-8b",
-#    api_key="GEMINIAPIKEY",
-#)
+# Azure OpenAI backend
+def create_azure_client(backend: Dict[str, Any]) -> ChatCompletionClient:
+    return AzureOpenAIChatCompletionClient(
+        model=get_backend_model(backend),
+        azure_endpoint=backend["azure_endpoint"],
+        azure_deployment=backend.get("azure_deployment", get_backend_model(backend)),
+        api_version=backend["api_version"],
+        api_key=get_backend_api_key(backend, "AZURE_OPENAI_API_KEY"),
+        http_client=create_http_client(),
+    )
+
+# OpenAI-compatible backend, e.g. a local vLLM or llama.cpp server
+def create_openai_compatible_client(backend: Dict[str, Any]) -> ChatCompletionClient:
+    return OpenAIChatCompletionClient(
+        model=get_backend_model(backend),
+        base_url=backend["base_url"],
+        # Local servers usually accept any key, but the OpenAI SDK insists on one
+        api_key=get_backend_api_key(backend, None) or "not-needed",
+        model_info={**OPENAI_COMPATIBLE_MODEL_INFO, **backend.get("model_info", {})},
+        http_client=create_http_client(),
+    )
+
+# Stub backend for offline runs
+def create_stub_client(backend: Dict[str, Any]) -> ChatCompletionClient:
+    return StubChatCompletionClient(backend.get("replies") or [STUB_REPLY])
+
+# Model backend registry, by the "type" of a backend in the config
+MODEL_BACKENDS: Dict[str, Callable[[Dict[str, Any]], ChatCompletionClient]] = {
+    "openai": create_openai_client,
+    "azure": create_azure_client,
+    "openai_compatible": create_openai_compatible_client,
+    "stub": create_stub_client,
+}
+
+# Model client factory
+def create_model_clients(config: Dict[str, Any]) -> Dict[str, ChatCompletionClient]:
+    """Create a model client for every configured backend; done in main() so replay runs need no API key."""
+    backends = config["backends"]
+    if "default" not in backends:
+        raise ValueError("The backends configuration needs a \"default\" backend")
+    for deity_name, backend_name in config["deity_backends"].items():
+        if backend_name not in backends:
+            raise ValueError(f"{deity_name} is mapped to unknown backend {backend_name!r}")
+    deity_names = {deity["name"] for deity in PANTHEON}
+    if config["summary"]["deity"] not in deity_names:
+        raise ValueError(f"summary.deity names unknown deity {config['summary']['deity']!r}")
+    for setting, names in (("roster", config["roster"] or []), ("budget.core_roster", config["budget"]["core_roster"])):
+        unknown = [name for name in names if name not in deity_names]
+        if unknown:
+            raise ValueError(f"{setting} names unknown deities {', '.join(map(repr, unknown))}; "
+                             f"expected any of {', '.join(sorted(deity_names))}")
+
+    clients = {}
+    for name, backend in backends.items():
+        if backend.get("type") not in MODEL_BACKENDS:
+            raise ValueError(f"Backend {name!r} has unknown type {backend.get('type')!r}; "
+                             f"expected one of {', '.join(MODEL_BACKENDS)}")
+        clients[name] = MODEL_BACKENDS[backend["type"]](backend)
+    return clients
+
+# Backend name of a deity
+def get_deity_backend(config: Dict[str, Any], deity_name: str) -> str:
+    return config["deity_backends"].get(deity_name, "default")
+
+# Model clients shared by every deity, by backend name
+model_clients: Dict[str, ChatCompletionClient] = {}
 
 ######################################
 # Content & Clarity Gods and Goddesses
 ######################################
 
 # 1. Style Guide Adherence - Apollo (God of Light, Music, and Poetry)
-apollo = AssistantAgent(
-    "Apollo",
-    model_client=model_client,
-    system_message="""You are Apollo, God of Light, Music, and Poetry, who serves as the Style Guide Adherence reviewer.
+apollo = {
+    "name": "Apollo",
+    "system_message": """You are Apollo, God of Light, Music, and Poetry, who serves as the Style Guide Adherence reviewer.
     
     Your divine attributes:
     - Master of harmony, poetry, and artistic expression
@@ -78,13 +945,12 @@ apollo = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect adherence to style guidelines.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]". 
     """
-)
+}
 
 # 2. Readability Improvement - Hermes (God of Language, Communication, and Travel)
-hermes = AssistantAgent(
-    "Hermes",
-    model_client=model_client,
-    system_message="""You are Hermes, God of Language, Communication, and Travel, who serves as the Readability Improvement reviewer.
+hermes = {
+    "name": "Hermes",
+    "system_message": """You are Hermes, God of Language, Communication, and Travel, who serves as the Readability Improvement reviewer.
 
     Your divine attributes:
     - Master of language and swift communication
@@ -108,13 +974,12 @@ hermes = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect readability.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".    
     """
-    )
+}
 
 # 3. Cognitive Load Reduction - Athena (Goddess of Wisdom and Strategic Warfare)
-athena = AssistantAgent(
-    "Athena",
-    model_client=model_client,
-    system_message="""You are Athena, Goddess of Wisdom and Strategic Warfare, who serves as the Cognitive Load Reduction reviewer.
+athena = {
+    "name": "Athena",
+    "system_message": """You are Athena, Goddess of Wisdom and Strategic Warfare, who serves as the Cognitive Load Reduction reviewer.
 
     Your divine attributes:
     - Bearer of practical wisdom and strategic thinking
@@ -136,13 +1001,12 @@ athena = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect cognitive load reduction.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 # 4. Diátaxis Adherence - Hestia (Goddess of the Hearth, Home, and Architecture)
-hestia = AssistantAgent(
-    "Hestia",
-    model_client=model_client,
-    system_message="""You are Hestia, Goddess of the Hearth, Home, and Architecture, who serves as the Diátaxis Adherence reviewer.
+hestia = {
+    "name": "Hestia",
+    "system_message": """You are Hestia, Goddess of the Hearth, Home, and Architecture, who serves as the Diátaxis Adherence reviewer.
 
     Your divine attributes:
     - Keeper of structured order and proper places
@@ -164,13 +1028,12 @@ hestia = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect adherence to the Diátaxis framework.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 # 5. Context Completeness - Mnemosyne (Titaness of Memory and Remembrance)
-mnemosyne = AssistantAgent(
-    "Mnemosyne",
-    model_client=model_client,
-    system_message="""You are Mnemosyne, Titaness of Memory and Mother of the Muses, who serves as the Context Completeness reviewer.
+mnemosyne = {
+    "name": "Mnemosyne",
+    "system_message": """You are Mnemosyne, Titaness of Memory and Mother of the Muses, who serves as the Context Completeness reviewer.
 
     Your divine attributes:
     - Keeper of all memory and complete knowledge
@@ -192,17 +1055,16 @@ mnemosyne = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect context completeness.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 ###########################################
 # Accuracy & Consistency Gods and Goddesses
 ###########################################
 
 # 6. Code Accuracy - Hephaestus (God of Craftsmen, Artisans, and Blacksmiths)
-hephaestus = AssistantAgent(
-    "Hephaestus",
-    model_client=model_client,
-    system_message="""You are Hephaestus, God of Craftsmen, Metallurgy, and Fire, who serves as the Code Accuracy reviewer.
+hephaestus = {
+    "name": "Hephaestus",
+    "system_message": """You are Hephaestus, God of Craftsmen, Metallurgy, and Fire, who serves as the Code Accuracy reviewer.
 
     Your divine attributes:
     - Master craftsman who forges perfect tools with exact specifications
@@ -224,13 +1086,12 @@ hephaestus = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect code accuracy.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 # 7. Cross-Linking - Heracles (Hero and God known for his Twelve Labors connecting the Greek world)
-heracles = AssistantAgent(
-    "Heracles",
-    model_client=model_client,
-    system_message="""You are Heracles, Hero and God renowned for connecting the Greek world through your Twelve Labors, who serves as the Cross-Linking reviewer.
+heracles = {
+    "name": "Heracles",
+    "system_message": """You are Heracles, Hero and God renowned for connecting the Greek world through your Twelve Labors, who serves as the Cross-Linking reviewer.
 
     Your divine attributes:
     - Champion who has traversed and connected all corners of the world
@@ -252,13 +1113,12 @@ heracles = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect cross-linking.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 # 8. Terminology Consistency - Demeter (Goddess of Agriculture, Fertility, and Sacred Law)
-demeter = AssistantAgent(
-    "Demeter",
-    model_client=model_client,
-    system_message="""You are Demeter, Goddess of Agriculture, Grain, and the Harvest, who serves as the Terminology Consistency reviewer.
+demeter = {
+    "name": "Demeter",
+    "system_message": """You are Demeter, Goddess of Agriculture, Grain, and the Harvest, who serves as the Terminology Consistency reviewer.
 
     Your divine attributes:
     - Keeper of cycles and seasonal consistency
@@ -280,17 +1140,16 @@ demeter = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect terminology consistency.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 #############################################
 # Presentation & Structure Gods and Goddesses
 #############################################
 
 # 9. Formatting - Aphrodite (Goddess of Beauty, Love, and Pleasure)
-aphrodite = AssistantAgent(
-    "Aphrodite",
-    model_client=model_client,
-    system_message="""You are Aphrodite, Goddess of Beauty, Love, and Aesthetic Pleasure, who serves as the Formatting reviewer.
+aphrodite = {
+    "name": "Aphrodite",
+    "system_message": """You are Aphrodite, Goddess of Beauty, Love, and Aesthetic Pleasure, who serves as the Formatting reviewer.
 
     Your divine attributes:
     - Arbiter of beauty and visual harmony
@@ -312,13 +1171,12 @@ aphrodite = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect formatting.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 # 10. Accessibility - Iris (Goddess of the Rainbow and Divine Messenger)
-iris = AssistantAgent(
-    "Iris",
-    model_client=model_client,
-    system_message="""You are Iris, Goddess of the Rainbow and Messenger between Realms, who serves as the Accessibility reviewer.
+iris = {
+    "name": "Iris",
+    "system_message": """You are Iris, Goddess of the Rainbow and Messenger between Realms, who serves as the Accessibility reviewer.
 
     Your divine attributes:
     - Creator of bridges between different worlds
@@ -340,13 +1198,12 @@ iris = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect accessibility.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 # 11. Visual Aid Suggestion - Dionysus (God of Wine, Festivities, and Theater)
-dionysus = AssistantAgent(
-    "Dionysus",
-    model_client=model_client,
-    system_message="""You are Dionysus, God of Wine, Ecstasy, and Theatre, who serves as the Visual Aid Suggestion reviewer.
+dionysus = {
+    "name": "Dionysus",
+    "system_message": """You are Dionysus, God of Wine, Ecstasy, and Theatre, who serves as the Visual Aid Suggestion reviewer.
 
     Your divine attributes:
     - Master of sensory experiences beyond mere words
@@ -368,17 +1225,16 @@ dionysus = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect visual aid suggestion.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 ######################################
 # Meta & Experience Gods and Goddesses
 ######################################
 
 # 12. Knowledge Decay - Chronos (Personification of Time and Aging)
-chronos = AssistantAgent(
-    "Chronos",
-    model_client=model_client,
-    system_message="""You are Chronos, Personification of Time and Inevitability, who serves as the Knowledge Decay reviewer.
+chronos = {
+    "name": "Chronos",
+    "system_message": """You are Chronos, Personification of Time and Inevitability, who serves as the Knowledge Decay reviewer.
 
     Your divine attributes:
     - Keeper of the passage of time and its effects on all things
@@ -400,17 +1256,16 @@ chronos = AssistantAgent(
     Finally, at the bottom of your review, score the code quality on a scale of 0-100, where 100 is perfect knowledge decay awareness.
     Assume high standards for production code. Output the score in the following format: "SCORE: [0-100]".
     """
-    )
+}
 
 ######################################
 # Summarization & Concluding Goddess
 ######################################
 
 # 13. Summarization - Atropos (Goddess of Final Judgment and Inevitable Conclusions)
-atropos = AssistantAgent(
-    "Atropos",
-    model_client=model_client,
-    system_message="""You are Atropos, the Goddess of Final Judgment and Inevitable Conclusions, who serves as the Summary Report Generator.
+atropos = {
+    "name": "Atropos",
+    "system_message": """You are Atropos, the Goddess of Final Judgment and Inevitable Conclusions, who serves as the Summary Report Generator.
 
     Your divine attributes:
     - Cutter of the thread that binds decisions
@@ -429,18 +1284,1421 @@ atropos = AssistantAgent(
 
     Once all 12 divine reviewers have performed their reviews and you have rendered your summary, please conclude with 'DOCUMENTATION REVIEW COMPLETE'.
     """
-)
+}
+
+# The full pantheon in speaking order; the "roster" setting selects who takes part
+PANTHEON = [apollo, hermes, athena, hestia, mnemosyne, hephaestus, heracles, demeter, aphrodite, iris, dionysus, chronos, atropos]
+
+##################
+# Agent lifecycle
+##################
+
+# Deity summoner
+def summon_deity(deity: Dict[str, str], config: Dict[str, Any]) -> AssistantAgent:
+    """
+    Create a fresh agent for one deity.
+
+    Agents are created per chunk and dropped afterwards, so no transcript carries
+    over from earlier chunks. Within a chunk, the model context keeps the task
+    and only the most recent replies, so prompt size has a fixed ceiling.
+    """
+    backend_name = get_deity_backend(config, deity["name"])
+    return AssistantAgent(
+        deity["name"],
+        model_client=InstrumentedChatCompletionClient(
+            model_clients[backend_name], deity["name"], get_backend_model(config["backends"][backend_name])),
+        system_message=deity["system_message"],
+        model_context=HeadAndTailChatCompletionContext(
+            head_size=1,
+            tail_size=config["agent_context"]["tail_messages"]
+        ),
+        model_client_stream=config["streaming"]["enabled"]
+    )
+
+# Pantheon summoner
+def summon_pantheon(roster: List[Dict[str, str]], config: Dict[str, Any]) -> List[AssistantAgent]:
+    """Create fresh agents for every deity on the roster, in speaking order."""
+    return [summon_deity(deity, config) for deity in roster]
+
+# Review reply validator
+def is_review_reply(content: str) -> bool:
+    """Tell whether a deity's reply is the JSON review the task asks for."""
+    try:
+        data = json.loads(content.strip())
+    except json.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and ("inlineReviews" in data or "generalReviews" in data)
+
+# Review termination condition
+class ReviewersReportedTermination(TerminationCondition):
+    """
+    Stop a team as soon as every scheduled reviewer has replied with a valid JSON
+    review, or after a hard cap of turns, so a chunk never costs more than a fixed
+    number of model calls.
+    """
+
+    def __init__(self, reviewers: List[str], max_turns: int) -> None:
+        self._reviewers = set(reviewers)
+        self._max_turns = max_turns
+        self._reported = set()
+        self._turns = 0
+        self._terminated = False
+
+    @property
+    def terminated(self) -> bool:
+        return self._terminated
 
+    async def __call__(self, messages) -> Optional[StopMessage]:
+        if self._terminated:
+            raise TerminatedException("Termination condition has already been reached")
+
+        for message in messages:
+            if not isinstance(message, BaseChatMessage) or message.source not in self._reviewers:
+                continue
+            self._turns += 1
+            if isinstance(message, TextMessage) and is_review_reply(message.content):
+                self._reported.add(message.source)
+
+        if self._reported >= self._reviewers:
+            self._terminated = True
+            return StopMessage(content=f"All {len(self._reviewers)} reviewers have reported",
+                               source="ReviewersReportedTermination")
+
+        if self._turns >= self._max_turns:
+            self._terminated = True
+            missing = ", ".join(sorted(self._reviewers - self._reported))
+            return StopMessage(content=f"Turn limit of {self._max_turns} reached without a valid review from {missing}",
+                               source="ReviewersReportedTermination")
+
+        return None
+
+    async def reset(self) -> None:
+        self._reported.clear()
+        self._turns = 0
+        self._terminated = False
+
+
+##########################
+# Review task definitions
+##########################
+
+# Static review instructions. They open every task and never change between
+# chunks, so the provider's automatic prompt caching can reuse them.
+REVIEW_INSTRUCTIONS = """Your task is to review the following changes from pull requests according to your divine domain of expertise. Instructions:
+- Respond in the following JSON format:
+{
+"inlineReviews": [
+    {
+    "filename": "<file path under review>",
+    "lineNumber": <lineNumber>,  // This is the line number in the new version of the file
+    "reviewComment": "[ReviewType] Poignant and actionable line-specific feedback. Brief reasoning."
+    }
+],
+"generalReviews": [
+    {
+    "filename": "<file path under review>",
+    "reviewComment": "Respective personality-based summary of content review. SCORE: [0-100] "
+    }
+]
+}
+- The file path under review is given with the diff at the end of this message.
+- The `lineNumber` is the number printed at the start of each line of the diff.
+- Only comment on lines that appear in the diff.
+- Create a reasonable amount of inlineReview comments (in the JSON format above) as necessary to improve the content without overwhelming the original author who will review the comments.
+- Create one general summary comment reflective of your divine personality that summarized the overall content review (in the JSON format above).
+- Do NOT wrap the output in triple backticks. DO NOT use markdown formatting like ```json.
+- Do NOT include explanations or extra commentary.
+- All comments should reflect your unique personality and domain.
+- Do NOT give positive comments or compliments.
+- Write the comment in GitHub Markdown format.
+- IMPORTANT: NEVER suggest adding comments to the code.
+- Your feedback should be specific, constructive, and actionable.
+"""
+
+# Review task builder
+def build_review_task(pr_details: Dict[str, Any], file_path: str, chunk: Dict[str, Any],
+                      repository_context: str = "") -> str:
+    """
+    Assemble a review task from its most to its least stable part: the static
+    instructions, then the PR context, then the chunk under review and any
+    repository facts about it. Every chunk of a PR therefore shares the same
+    prompt prefix after the system message.
+    """
+    # Prefix each line with its line number in the new file, which is what comments refer to
+    changes_text = ""
+    for change in chunk['changes']:
+        line_content = change['content'].rstrip("\n")
+        changes_text += f"{change['ln']:>5} {line_content}\n"
+
+    return f"""{REVIEW_INSTRUCTIONS}
+Pull request title: {pr_details['title']}
+Pull request description:
+
+---
+{pr_details['description']}
+---
+
+Review the following code diff in the file "{file_path}".
+
+Git diff to review:
+
+```diff
+{chunk['content']}
+{changes_text}```
+""" + (f"\nRepository facts about this chunk:\n\n{repository_context}\n" if repository_context else "")
+
+#############################
+# Review planning and budgets
+#############################
+
+# Token encoding lookup
+@functools.lru_cache(maxsize=8)
+def get_token_encoding(model: str) -> Any:
+    """
+    Return the tiktoken encoding for a model, falling back to the current OpenAI
+    encoding, or None when the encoding files cannot be loaded (e.g. offline runners).
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"⚠️ Could not load a tokenizer for {model}, approximating token counts: {e}")
+        return None
+
+# Token counter
+def count_tokens(text: str, model: str) -> int:
+    """Count the tokens a model will see for a piece of text."""
+    encoding = get_token_encoding(model)
+    if encoding is None:
+        # English prose averages about four characters per token
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+# Active roster selector
+def select_roster(config: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Return the deities taking part in this run, in speaking order."""
+    if not config["roster"]:
+        return list(PANTHEON)
+    return [deity for deity in PANTHEON if deity["name"] in config["roster"]]
+
+# Task token counter
+def count_task_tokens(parsed_files: List[Dict[str, Any]], pr_details: Dict[str, Any], model: str) -> List[int]:
+    """Count the tokens of every chunk's review task, once per plan."""
+    return [count_tokens(build_review_task(pr_details, file_data['to'], file_data['chunk']), model)
+            for file_data in parsed_files]
+
+# Review cost estimator
+def estimate_review_cost(task_tokens: List[int], roster: List[Dict[str, str]], config: Dict[str, Any],
+                         model: str) -> Dict[str, Any]:
+    """Project the model calls, tokens, cost and wall time of reviewing chunks of these task sizes with the roster."""
+    budget = config["budget"]
+    completion_tokens = budget["expected_completion_tokens"]
+    system_tokens = [count_tokens(deity["system_message"], model) for deity in roster]
+
+    # In the round robin every deity also reads the replies of the deities before it
+    prompt_tokens = sum(system + tokens + turn * completion_tokens
+                        for tokens in task_tokens for turn, system in enumerate(system_tokens))
+
+    model_calls = len(task_tokens) * len(roster)
+    price = get_model_price(config["model_prices"], model)
+    return {
+        'chunks': len(task_tokens),
+        'deities': len(roster),
+        'model_calls': model_calls,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': model_calls * completion_tokens,
+        'cost_usd': (prompt_tokens * price['prompt'] + model_calls * completion_tokens * price['completion']) / 1_000_000,
+        'minutes': model_calls * budget["seconds_per_call"] / 60
+    }
+
+# Budget checker
+def find_budget_overruns(plan: Dict[str, Any], budget: Dict[str, Any]) -> Dict[str, float]:
+    """Return, for every exceeded limit, how many times over the limit the plan is."""
+    limits = {'cost_usd': budget.get("max_cost_usd"),
+              'model_calls': budget.get("max_model_calls"),
+              'minutes': budget.get("max_minutes")}
+    return {key: plan[key] / limit for key, limit in limits.items()
+            if limit is not None and plan[key] > limit}
+
+# Plan formatter
+def format_review_plan(plan: Dict[str, Any]) -> str:
+    """Describe a review plan in one line."""
+    return (f"{plan['chunks']} chunks x {plan['deities']} deities = {plan['model_calls']} model calls, "
+            f"~{plan['prompt_tokens'] + plan['completion_tokens']} tokens, "
+            f"~${plan['cost_usd']:.2f}, ~{plan['minutes']:.0f} min")
+
+# Chunk sampler
+def sample_chunks(parsed_files: List[Dict[str, Any]], count: int) -> List[Dict[str, Any]]:
+    """Pick count chunks spread evenly across the diff, keeping their original order."""
+    if count >= len(parsed_files):
+        return list(parsed_files)
+    step = len(parsed_files) / count
+    return [parsed_files[int(i * step)] for i in range(count)]
+
+# Budget guard
+def apply_review_budget(parsed_files: List[Dict[str, Any]], roster: List[Dict[str, str]],
+                        pr_details: Dict[str, Any], config: Dict[str, Any],
+                        model: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]], Optional[str]]:
+    """
+    Fit the planned review into the configured budget before any model call is made.
+
+    Returns the chunks and roster to review with, plus a notice for the PR when
+    the review was cut down or aborted. An aborted review has no chunks left.
+    """
+    budget = config["budget"]
+    task_tokens = count_task_tokens(parsed_files, pr_details, model)
+    plan = estimate_review_cost(task_tokens, roster, config, model)
+    print(f"Review plan: {format_review_plan(plan)}")
+
+    overruns = find_budget_overruns(plan, budget)
+    if not overruns:
+        return parsed_files, roster, None
+
+    exceeded = ", ".join(overruns)
+    full_plan = format_review_plan(plan)
+    if budget["action"] == "abort":
+        return [], roster, (f"The divine pantheon declined to review this PR: the planned review "
+                            f"({full_plan}) exceeds the configured budget for {exceeded}.")
+
+    notices = []
+    if budget["action"] == "narrow":
+        core_roster = [deity for deity in roster if deity["name"] in budget["core_roster"]]
+        if core_roster and len(core_roster) < len(roster):
+            roster = core_roster
+            plan = estimate_review_cost(task_tokens, roster, config, model)
+            overruns = find_budget_overruns(plan, budget)
+            notices.append(f"only {', '.join(deity['name'] for deity in roster)} took part")
+
+    if overruns:
+        # Cost and time grow roughly linearly with the number of chunks
+        count = math.floor(len(parsed_files) / max(overruns.values()))
+        while count > 0:
+            sampled = sample_chunks(list(range(len(parsed_files))), count)
+            sampled_files = [parsed_files[i] for i in sampled]
+            plan = estimate_review_cost([task_tokens[i] for i in sampled], roster, config, model)
+            if not find_budget_overruns(plan, budget):
+                break
+            count = math.floor(count * 0.9)
+        if count == 0:
+            return [], roster, (f"The divine pantheon declined to review this PR: even a single chunk "
+                                f"exceeds the configured budget for {exceeded}.")
+        notices.append(f"{count} of {len(parsed_files)} changed chunks were sampled")
+        parsed_files = sampled_files
+
+    print(f"Budgeted review plan: {format_review_plan(plan)}")
+    return parsed_files, roster, (f"The planned review ({full_plan}) exceeds the configured budget for "
+                                  f"{exceeded}, so {' and '.join(notices)}.")
+
+# Chunk priority scorer
+def score_chunk(file_data: Dict[str, Any], schedule: Dict[str, Any],
+                path_matchers: List[Tuple[Callable[[str], bool], float]]) -> float:
+    """Score how valuable a chunk is to review, from features that cost nothing to compute."""
+    path = re.sub(r"^b/", "", file_data['to'])
+    added_lines = [change['content'] for change in file_data['chunk']['changes']
+                   if change['content'].startswith('+')]
+
+    score = schedule["file_type_weights"].get(os.path.splitext(path)[1].lower(), 0.0)
+    score += max((weight for matches, weight in path_matchers if matches(path)), default=0.0)
+    score += schedule["added_line_weight"] * min(len(added_lines), 50)
+    if any(line[1:].lstrip().startswith(("```", "~~~")) for line in added_lines):
+        score += schedule["code_block_weight"]
+    return score
+
+# Chunk prioritizer
+def prioritize_chunks(parsed_files: List[Dict[str, Any]], config: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Order chunks from most to least valuable, keeping diff order between equal scores."""
+    schedule = config["schedule"]
+    path_matchers = [(compile_path_matcher([pattern]), weight)
+                     for pattern, weight in schedule["path_weights"].items()]
+    return sorted(parsed_files, key=lambda file_data: -score_chunk(file_data, schedule, path_matchers))
+
+###########################
+# Oversized chunk windows
+###########################
+
+# Markdown heading, the preferred place to split a chunk
+MARKDOWN_HEADING_RE = re.compile(r"#{1,6}\s")
+
+# Split point finder
+def find_window_breaks(changes: List[Dict[str, Any]]) -> Tuple[set, set]:
+    """Return the offsets of lines that start a markdown section, and of blank lines, outside code fences."""
+    headings, blanks = set(), set()
+    in_fence = False
+    for offset, change in enumerate(changes):
+        text = change['content'][1:].strip()
+        if text.startswith(("```", "~~~")):
+            in_fence = not in_fence
+        elif in_fence:
+            continue
+        elif MARKDOWN_HEADING_RE.match(text):
+            headings.add(offset)
+        elif not text:
+            blanks.add(offset + 1)
+    return headings, blanks
+
+# Oversized chunk splitter
+def split_oversized_chunk(file_data: Dict[str, Any], windows: Dict[str, Any], model: str) -> List[Dict[str, Any]]:
+    """
+    Split a chunk over the token limit into windows of consecutive lines.
+
+    A window ends before the last markdown heading that keeps it at least half
+    full, else after the last blank line, else at the limit. Lines keep their
+    new-file line numbers, so comments need no remapping. Each window lists its
+    leading overlap lines under 'overlap_lines'.
+    """
+    chunk = file_data['chunk']
+    changes = chunk['changes']
+    line_tokens = [count_tokens(change['content'], model) for change in changes]
+    if sum(line_tokens) <= windows["max_tokens"]:
+        return [file_data]
+
+    headings, blanks = find_window_breaks(changes)
+    bounds = []
+    start = 0
+    while start < len(changes):
+        end, tokens = start, 0
+        while end < len(changes) and (end == start or tokens + line_tokens[end] <= windows["max_tokens"]):
+            tokens += line_tokens[end]
+            end += 1
+        if end < len(changes):
+            half = max(start + (end - start) // 2, start + 1)
+            end = (max((offset for offset in headings if half <= offset < end), default=0)
+                   or max((offset for offset in blanks if half <= offset < end), default=0)
+                   or end)
+        bounds.append((start, end))
+        start = end
+
+    split = []
+    for part, (start, end) in enumerate(bounds, 1):
+        overlap_start = max(start - windows["overlap_lines"], 0)
+        split.append(dict(file_data, chunk={
+            'content': f"{chunk['content']} part {part} of {len(bounds)}",
+            'changes': changes[overlap_start:end],
+            'overlap_lines': [change['ln'] for change in changes[overlap_start:start]],
+        }))
+    return split
+
+# Oversized chunk post-processor for parse_diff output
+def split_oversized_chunks(parsed_files: List[Dict[str, Any]], windows: Dict[str, Any],
+                           model: str) -> List[Dict[str, Any]]:
+    """Replace every chunk over the token limit with its windows."""
+    split = [window for file_data in parsed_files for window in split_oversized_chunk(file_data, windows, model)]
+    if len(split) > len(parsed_files):
+        print(f"Split oversized chunks into windows; {len(split)} chunks to review")
+    return split
+
+# Overlap comment filter
+def drop_overlap_comments(chunk: Dict[str, Any], inline_comments: List[Dict]) -> List[Dict]:
+    """Drop a window's comments on its overlap lines, which the previous window reviews."""
+    overlap_lines = set(chunk.get('overlap_lines', ()))
+    if not overlap_lines:
+        return inline_comments
+    return [comment for comment in inline_comments if comment['lineNumber'] not in overlap_lines]
+
+##################################
+# Near-duplicate chunk detection
+##################################
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_PRIME = (1 << 61) - 1
+# Fixed seeds keep signatures, and therefore groups, stable between runs
+MINHASH_SEEDS = [(int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") | 1,
+                  int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big"))
+                 for i in range(MINHASH_PERMUTATIONS)]
+
+# Changed line normalizer
+def normalize_line(content: str) -> str:
+    """Normalize a diff line for comparison: drop the +/space marker, case and whitespace differences."""
+    return " ".join(content[1:].split()).lower()
+
+# Added text extractor
+def get_added_lines(chunk: Dict[str, Any]) -> List[str]:
+    """Return the normalized, non-blank lines a chunk adds."""
+    return [normalize_line(change['content']) for change in chunk['changes']
+            if change['content'].startswith('+') and change['content'][1:].strip()]
+
+# Edit text extractor
+def get_edit_lines(chunk: Dict[str, Any]) -> List[str]:
+    """Return the normalized, non-blank removed and added lines of a chunk, each with its marker."""
+    contents = chunk.get('removed', []) + [change['content'] for change in chunk['changes']
+                                           if change['content'].startswith('+')]
+    return [content[0] + normalize_line(content) for content in contents if content[1:].strip()]
+
+# Added line numbers of a chunk
+def get_added_line_numbers(chunk: Dict[str, Any]) -> set:
+    return {change['ln'] for change in chunk['changes'] if change['content'].startswith('+')}
+
+# Word trigram shingler
+def chunk_shingles(lines: List[str]) -> set:
+    """Return the word trigrams of a chunk's lines."""
+    words = " ".join(lines).split()
+    return {" ".join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))}
+
+# MinHash signature builder
+def minhash_signature(shingles: set) -> List[int]:
+    """Build a MinHash signature over a chunk's shingles."""
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+              for shingle in shingles]
+    return [min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in MINHASH_SEEDS]
+
+# Duplicate chunk grouper
+def group_duplicate_chunks(parsed_files: List[Dict[str, Any]], dedup: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Group identical and near-identical chunks and return one representative per group.
+
+    Chunks are compared on the edit itself, their removed and added lines, so the
+    same rename matches wherever it happens. Identical edits are matched by hash;
+    near-identical ones by MinHash with locality-sensitive banding, so grouping
+    stays linear in the number of chunks. Pure additions with fewer than
+    min_shingles word trigrams (e.g. a lone heading) are too small to tell apart
+    and are never grouped. Each representative lists the rest of its group
+    under 'duplicates'.
+    """
+    if not dedup["enabled"]:
+        return parsed_files
+
+    parent = list(range(len(parsed_files)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i: int, j: int) -> None:
+        # The earliest chunk in the diff stays the representative
+        i, j = find(i), find(j)
+        parent[max(i, j)] = min(i, j)
+
+    exact_buckets, band_buckets, signatures = {}, {}, {}
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    for i, file_data in enumerate(parsed_files):
+        # Deletion-only chunks have nothing in common but their emptiness
+        if not get_added_lines(file_data['chunk']):
+            continue
+        lines = get_edit_lines(file_data['chunk'])
+        shingles = chunk_shingles(lines)
+        if not file_data['chunk'].get('removed') and len(shingles) < dedup["min_shingles"]:
+            continue
+
+        digest = hashlib.sha256("\n".join(lines).encode()).hexdigest()
+        if digest in exact_buckets:
+            union(exact_buckets[digest], i)
+            continue
+        exact_buckets[digest] = i
+
+        signatures[i] = minhash_signature(shingles)
+        for band in range(MINHASH_BANDS):
+            key = (band, tuple(signatures[i][band * rows:(band + 1) * rows]))
+            for j in band_buckets.setdefault(key, []):
+                if find(i) == find(j):
+                    continue
+                similarity = sum(a == b for a, b in zip(signatures[i], signatures[j])) / MINHASH_PERMUTATIONS
+                if similarity >= dedup["near_duplicate_threshold"]:
+                    union(i, j)
+            band_buckets[key].append(i)
+
+    representatives = {}
+    for i, file_data in enumerate(parsed_files):
+        root = find(i)
+        if root == i:
+            representatives[i] = dict(file_data, duplicates=[])
+        else:
+            representatives[root]['duplicates'].append(file_data)
+
+    grouped = sum(len(file_data['duplicates']) for file_data in representatives.values())
+    if grouped:
+        print(f"Grouped {grouped} duplicate chunks; {len(representatives)} chunks left to review")
+    return list(representatives.values())
+
+# Changed line mapper
+def map_chunk_line(source: Dict[str, Any], target: Dict[str, Any], line_number: int) -> Optional[int]:
+    """Map a line of one chunk to the matching line of a duplicate chunk, by content and then by offset."""
+    source_changes = source['changes']
+    offsets = [i for i, change in enumerate(source_changes) if change['ln'] == line_number]
+    if not offsets:
+        return None
+    offset = offsets[0]
+
+    content = normalize_line(source_changes[offset]['content'])
+    target_changes = target['changes']
+    matches = [change['ln'] for change in target_changes if normalize_line(change['content']) == content]
+    if matches:
+        # Prefer the match closest to the same position in the chunk
+        return min(matches, key=lambda ln: abs(ln - target_changes[0]['ln'] - offset))
+    if offset < len(target_changes):
+        return target_changes[offset]['ln']
+    return None
+
+# Duplicate comment fan-out
+def fan_out_duplicate_comments(file_data: Dict[str, Any], inline_comments: List[Dict],
+                               general_comments: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Copy a representative chunk's inline comments to its duplicates and note them in general comments.
+
+    Only comments on changed lines are copied, and only onto changed lines:
+    the surrounding context differs between copies, so a comment on it may not
+    apply elsewhere.
+    """
+    duplicates = file_data.get('duplicates') or []
+    if not duplicates:
+        return inline_comments, general_comments
+
+    fanned_out = list(inline_comments)
+    changed_lines = get_added_line_numbers(file_data['chunk'])
+    for duplicate in duplicates:
+        duplicate_changed_lines = get_added_line_numbers(duplicate['chunk'])
+        for comment in inline_comments:
+            if comment['lineNumber'] not in changed_lines:
+                continue
+            line_number = map_chunk_line(file_data['chunk'], duplicate['chunk'], comment['lineNumber'])
+            if line_number in duplicate_changed_lines:
+                fanned_out.append(dict(comment, filename=duplicate['to'], lineNumber=line_number))
+
+    locations = ", ".join(sorted({f"`{re.sub(r'^b/', '', duplicate['to'])}`" for duplicate in duplicates}))
+    annotated = [dict(comment, body=f"{comment['body']}\n\n_The same change also appears in {locations}._")
+                 for comment in general_comments]
+    return fanned_out, annotated
+
+##########################
+# Semantic review cache
+##########################
+
+EMBEDDING_DIMENSIONS = 1024
+
+# Chunk embedder
+def embed_chunk(chunk: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Embed a chunk's added text as a sparse, unit-length vector of hashed word
+    unigrams and bigrams. Case, whitespace, line wrapping and digits are
+    normalized away first, so reflowed lines and version bumps embed alike.
+    """
+    words = re.sub(r"\d+", "0", " ".join(get_added_lines(chunk))).split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    vector: Dict[str, float] = {}
+    for feature in features:
+        dimension = str(int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "big")
+                        % EMBEDDING_DIMENSIONS)
+        vector[dimension] = vector.get(dimension, 0.0) + 1.0
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {dimension: round(weight / norm, 4) for dimension, weight in vector.items()} if norm else {}
+
+# Cosine similarity of unit-length sparse vectors
+def cosine_similarity(a: Dict[str, float], b: Dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(dimension, 0.0) for dimension, weight in a.items())
+
+# Deity fingerprint
+def deity_fingerprint(deity: Dict[str, str], config: Dict[str, Any]) -> str:
+    """Identify a deity's prompt and model, so cached reviews are dropped when either changes."""
+    model = get_backend_model(config["backends"][get_deity_backend(config, deity["name"])])
+    return hashlib.sha256(f"{model}\n{deity['system_message']}".encode()).hexdigest()[:16]
+
+# Persisted vector index of reviewed chunks
+class SemanticReviewCache:
+    """
+    Past chunks with each deity's review of them, looked up by embedding similarity.
+
+    Lookups scan every entry, which is fast at the capped size. Entries remember
+    when they were last used, and the least recently used are evicted on save.
+    """
+
+    def __init__(self, path: str, similarity_threshold: float, max_entries: int) -> None:
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.entries: List[Dict[str, Any]] = []
+        self.hits = 0
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries = json.load(f)["entries"]
+            print(f"Loaded {len(self.entries)} cached chunk reviews from {path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable review cache {path}: {e}")
+
+    def lookup(self, vector: Dict[str, float]) -> Optional[Dict[str, Any]]:
+        """Return the most similar past chunk, if it passes the similarity threshold."""
+        if not vector:
+            return None
+        best, best_similarity = None, self.similarity_threshold
+        for entry in self.entries:
+            similarity = cosine_similarity(vector, entry['vector'])
+            if similarity >= best_similarity:
+                best, best_similarity = entry, similarity
+        if best is not None:
+            best['last_used'] = time.time()
+        return best
+
+    def get_reviews(self, entry: Dict[str, Any], deity_name: str, fingerprint: str, file_path: str,
+                    chunk: Dict[str, Any]) -> Optional[Tuple[List[Dict], List[Dict]]]:
+        """Return a deity's cached comments, remapped onto the lines of the new chunk."""
+        review = entry['reviews'].get(deity_name)
+        if review is None or review['fingerprint'] != fingerprint:
+            return None
+        self.hits += 1
+
+        inline_comments = []
+        for comment in review['inline']:
+            line_number = map_chunk_line(entry['chunk'], chunk, comment['lineNumber'])
+            if line_number is not None:
+                inline_comments.append({"deity": deity_name, "filename": file_path,
+                                        "lineNumber": line_number, "body": comment['body']})
+        general_comments = [{"deity": deity_name, "filename": file_path, "body": body}
+                            for body in review['general']]
+        return inline_comments, general_comments
+
+    def store(self, entry: Optional[Dict[str, Any]], vector: Dict[str, float], chunk: Dict[str, Any],
+              reviews: Dict[str, Dict[str, Any]]) -> None:
+        """Add fresh deity reviews to the matched entry, or to a new entry for this chunk."""
+        if not vector or not reviews:
+            return
+        if entry is None:
+            entry = {'vector': vector, 'chunk': {'changes': chunk['changes']}, 'reviews': {}}
+            self.entries.append(entry)
+        else:
+            # Lines are kept relative to the entry's chunk, which get_reviews maps from
+            for review in reviews.values():
+                review['inline'] = [
+                    dict(comment, lineNumber=line_number) for comment in review['inline']
+                    for line_number in [map_chunk_line(chunk, entry['chunk'], comment['lineNumber'])]
+                    if line_number is not None]
+        entry['reviews'].update(reviews)
+        entry['last_used'] = time.time()
+
+    def save(self) -> None:
+        """Write the index back to disk, evicting the least recently used entries beyond the cap."""
+        self.entries.sort(key=lambda entry: entry['last_used'], reverse=True)
+        del self.entries[self.max_entries:]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({'entries': self.entries}, f)
+        print(f"Saved {len(self.entries)} cached chunk reviews to {self.path} ({self.hits} reused this run)")
+
+# Semantic review caches by path, kept loaded between PRs in server mode
+review_caches: Dict[str, SemanticReviewCache] = {}
+
+# Semantic review cache grabber
+def get_review_cache(config: Dict[str, Any]) -> Optional[SemanticReviewCache]:
+    """Return the configured review cache, loading it from disk on first use."""
+    semantic_cache = config["semantic_cache"]
+    if not semantic_cache["enabled"]:
+        return None
+    if semantic_cache["path"] not in review_caches:
+        review_caches[semantic_cache["path"]] = SemanticReviewCache(
+            semantic_cache["path"], semantic_cache["similarity_threshold"], semantic_cache["max_entries"])
+    return review_caches[semantic_cache["path"]]
+
+#########################
+# Documentation index
+#########################
+
+# Markdown headings and inline links
+ATX_HEADING_RE = re.compile(r"(#{1,6})\s+(.*?)(?:\s+#+)?\s*$")
+MARKDOWN_LINK_RE = re.compile(r"\[[^\]]*\]\(\s*<?([^)\s>]+)>?(?:\s+\"[^\"]*\")?\s*\)")
+URL_SCHEME_RE = re.compile(r"^[a-zA-Z][a-zA-Z0-9+.-]*:")
+TERM_RE = re.compile(r"[A-Za-z][A-Za-z0-9]*(?:[-/][A-Za-z0-9]+)*")
+
+# Words too common to tell pages or term variants apart
+STOPWORDS = frozenset("""a an and are as at be by can do for from has have how if in into is it its not of on or
+so than that the their then there these this to use using was we what when which will with you your""".split())
+
+# Heading anchor builder
+def heading_anchor(title: str, seen: Dict[str, int]) -> str:
+    """Return GitHub's anchor for a heading, numbering repeats the way GitHub does."""
+    anchor = re.sub(r"[^\w\- ]", "", title.strip().lower()).replace(" ", "-")
+    count = seen.get(anchor, 0)
+    seen[anchor] = count + 1
+    return f"{anchor}-{count}" if count else anchor
+
+# Term variant key
+def term_key(form: str) -> str:
+    """Reduce a term to the key its spelling variants share: "Sign-in", "sign in" and "signin" are one term."""
+    return re.sub(r"[^a-z0-9]", "", form.lower())
+
+# Term form normalizer
+def term_form(word: str) -> str:
+    """Lowercase a capital that only starts a sentence, keeping deliberate casing such as "GitHub"."""
+    return word.lower() if word[1:] == word[1:].lower() else word
+
+# Page indexer
+def index_page(path: str, text: str) -> Dict[str, Any]:
+    """Extract the headings, links and term counts of one Markdown page."""
+    headings, seen_anchors, links = [], {}, []
+    words: Dict[str, int] = {}
+    pairs: Dict[str, int] = {}
+    in_code = False
+    for line in text.splitlines():
+        if line.lstrip().startswith(("```", "~~~")):
+            in_code = not in_code
+            continue
+        if in_code:
+            continue
+        heading = ATX_HEADING_RE.match(line)
+        if heading:
+            title = heading.group(2).strip()
+            headings.append([title, heading_anchor(title, seen_anchors)])
+        for target in MARKDOWN_LINK_RE.findall(line):
+            if not URL_SCHEME_RE.match(target):
+                links.append(resolve_link(path, target))
+        forms = [term_form(word) for word in TERM_RE.findall(MARKDOWN_LINK_RE.sub("", line))]
+        for form in forms:
+            if len(form) > 2 and form.lower() not in STOPWORDS:
+                words[form] = words.get(form, 0) + 1
+        for first, second in zip(forms, forms[1:]):
+            if first.isalpha() and second.isalpha() and not {first.lower(), second.lower()} <= STOPWORDS:
+                pair = f"{first} {second}"
+                pairs[pair] = pairs.get(pair, 0) + 1
+    return {'headings': headings, 'links': links, 'words': words, 'pairs': pairs}
+
+# Relative link resolver
+def resolve_link(path: str, target: str) -> str:
+    """Resolve a link on a page to a checkout path, keeping any #anchor."""
+    target_path, _, anchor = target.partition("#")
+    if not target_path:
+        resolved = path
+    elif target_path.startswith("/"):
+        resolved = target_path.lstrip("/")
+    else:
+        resolved = os.path.normpath(os.path.join(os.path.dirname(path), target_path)).replace(os.sep, "/")
+    return f"{resolved}#{anchor}" if anchor else resolved
+
+# Persisted index of the documentation in the checkout
+class DocsIndex:
+    """
+    Headings, links and term counts of every documentation page in the checkout.
+
+    Pages are re-read on every refresh but only re-indexed when their content
+    hash changes. The views the deities are given (term variants, inbound links
+    and a heading word index) are rebuilt from the page entries after a refresh.
+    """
+
+    def __init__(self, path: str, root: str, include: List[str], exclude: List[str]) -> None:
+        self.path = path
+        self.root = root
+        self.is_indexed = build_path_filter(include, exclude)
+        # Excluded directories are skipped whole, unless a "!" rule could re-include something below them
+        is_excluded = compile_path_matcher(exclude)
+        self.is_pruned = (lambda path: False) if any(rule.strip().startswith("!") for rule in exclude) else is_excluded
+        self.lock = threading.Lock()
+        self.pages: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.pages = json.load(f)["pages"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable documentation index {path}: {e}")
+
+    def refresh(self) -> None:
+        """Bring the index up to date with the checkout and rebuild its views."""
+        pages, reindexed = {}, 0
+        for directory, subdirectories, files in os.walk(self.root):
+            relative = os.path.relpath(directory, self.root).replace(os.sep, "/")
+            subdirectories[:] = [name for name in subdirectories if name != ".git" and not self.is_pruned(
+                name if relative == "." else f"{relative}/{name}")]
+            for name in files:
+                page_path = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, "/")
+                if not self.is_indexed(page_path):
+                    continue
+                try:
+                    with open(os.path.join(directory, name), "rb") as f:
+                        content = f.read()
+                except OSError:
+                    continue
+                digest = hashlib.sha256(content).hexdigest()
+                page = self.pages.get(page_path)
+                if page is None or page['hash'] != digest:
+                    page = dict(index_page(page_path, content.decode("utf-8", "replace")), hash=digest)
+                    reindexed += 1
+                pages[page_path] = page
+        print(f"Indexed {len(pages)} documentation pages ({reindexed} changed since the last run)")
+
+        # Spelling variants of each term across the docs
+        variants: Dict[str, Dict[str, int]] = {}
+        for page in pages.values():
+            for form, count in page['words'].items():
+                forms = variants.setdefault(term_key(form), {})
+                forms[form] = forms.get(form, 0) + count
+        for page in pages.values():
+            for form, count in page['pairs'].items():
+                forms = variants.get(term_key(form))
+                if forms is not None:
+                    forms[form] = forms.get(form, 0) + count
+
+        # Inbound links, and the headings each word appears in
+        inbound: Dict[str, List[str]] = {}
+        heading_words: Dict[str, List[Tuple[str, int]]] = {}
+        for page_path, page in pages.items():
+            for link in page['links']:
+                target = link.partition("#")[0]
+                if target != page_path and page_path not in inbound.setdefault(target, []):
+                    inbound[target].append(page_path)
+            for position, (title, _) in enumerate(page['headings']):
+                for word in {word.lower() for word in TERM_RE.findall(title)} - STOPWORDS:
+                    heading_words.setdefault(word, []).append((page_path, position))
+
+        # Swapped in together, so reviews running alongside never see a half-built index
+        self.pages, self.inbound, self.heading_words = pages, inbound, heading_words
+        self.variants = {key: forms for key, forms in variants.items() if len(forms) > 1}
+
+    def save(self) -> None:
+        """Write the page entries back to disk."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({'pages': self.pages}, f)
+
+    def link_target_problem(self, link: str) -> Optional[str]:
+        """Describe what is wrong with a resolved link target, if anything."""
+        target, _, anchor = link.partition("#")
+        page = self.pages.get(target)
+        if page is None:
+            return None if os.path.exists(os.path.join(self.root, target)) else "no such file"
+        if anchor and anchor not in {heading_anchor for _, heading_anchor in page['headings']}:
+            return "no such heading"
+        return None
+
+    def terminology_facts(self, chunk: Dict[str, Any], max_terms: int) -> List[str]:
+        """List the terms of a chunk that the docs spell in more than one way, most common spelling first."""
+        used: Dict[str, str] = {}
+        for line in chunk_added_text(chunk):
+            forms = [term_form(word) for word in TERM_RE.findall(line)]
+            for form in forms + [f"{a} {b}" for a, b in zip(forms, forms[1:])]:
+                if term_key(form) in self.variants:
+                    used.setdefault(term_key(form), form)
+
+        facts = []
+        for key, form in used.items():
+            forms = sorted(self.variants[key].items(), key=lambda item: item[1], reverse=True)
+            spellings = ", ".join(f'"{variant}" x{count}' for variant, count in forms)
+            facts.append((forms[0][0] != form, sum(self.variants[key].values()),
+                          f'- "{form}" is spelled {spellings} across the docs'))
+        facts.sort(key=lambda fact: fact[:2], reverse=True)
+        return [fact for _, _, fact in facts[:max_terms]]
+
+    def link_facts(self, file_path: str, chunk: Dict[str, Any], max_links: int) -> List[str]:
+        """List the page's place in the link graph, broken links in the chunk, and headings it could link to."""
+        facts = []
+        inbound = self.inbound.get(file_path, [])
+        if inbound:
+            facts.append(f"- Linked from: {', '.join(inbound[:max_links])}")
+        for line in chunk_added_text(chunk):
+            for target in MARKDOWN_LINK_RE.findall(line):
+                if URL_SCHEME_RE.match(target):
+                    continue
+                problem = self.link_target_problem(resolve_link(file_path, target))
+                if problem:
+                    facts.append(f"- Broken link in this chunk: {target} ({problem})")
+
+        # Headings elsewhere that share the rarest words with the chunk
+        scores: Dict[Tuple[str, int], float] = {}
+        words = {word.lower() for line in chunk_added_text(chunk) for word in TERM_RE.findall(line)} - STOPWORDS
+        for word in words:
+            headings = self.heading_words.get(word, [])
+            for heading in headings:
+                if heading[0] != file_path:
+                    scores[heading] = scores.get(heading, 0.0) + 1.0 / len(headings)
+        directory = os.path.dirname(file_path) or "."
+        for page_path, position in sorted(scores, key=scores.get, reverse=True)[:max_links]:
+            title, anchor = self.pages[page_path]['headings'][position]
+            facts.append(f"- Related section: [{title}]({os.path.relpath(page_path, directory)}#{anchor})")
+        return facts
+
+# Added text reader
+def chunk_added_text(chunk: Dict[str, Any]) -> List[str]:
+    """Return the text a chunk adds, with its case intact."""
+    return [change['content'][1:] for change in chunk['changes'] if change['content'].startswith('+')]
+
+# Documentation indexes by path, loaded once per process
+docs_indexes: Dict[str, DocsIndex] = {}
+
+# Documentation index grabber
+def get_docs_index(config: Dict[str, Any]) -> Optional[DocsIndex]:
+    """Return the configured documentation index, brought up to date with the checkout."""
+    docs_index = config["docs_index"]
+    if not docs_index["enabled"]:
+        return None
+    if docs_index["path"] not in docs_indexes:
+        docs_indexes[docs_index["path"]] = DocsIndex(
+            docs_index["path"], os.environ.get("GITHUB_WORKSPACE", "."), docs_index["include"], docs_index["exclude"])
+    index = docs_indexes[docs_index["path"]]
+    with index.lock:
+        index.refresh()
+        index.save()
+    return index
+
+##################
+# Staleness index
+##################
+
+# Paths a page may mention: anything with a slash, or a file name with an extension
+PATH_TOKEN_RE = re.compile(r"[\w.@-]+(?:/[\w.@-]+)+/?|[\w-]+\.[A-Za-z]{1,5}\b")
+
+# Git runner
+def run_git(root: str, *args: str) -> str:
+    """Run a git command in the checkout and return its output."""
+    return subprocess.run(["git", "-C", root, *args], capture_output=True, text=True, check=True).stdout
+
+# Git blob reader
+def read_git_blobs(root: str, blobs: List[str]) -> List[str]:
+    """Read many blobs with one git process."""
+    output = subprocess.run(["git", "-C", root, "cat-file", "--batch"],
+                            input="".join(f"{blob}\n" for blob in blobs).encode(), capture_output=True,
+                            check=True).stdout
+    texts, position = [], 0
+    for _ in blobs:
+        header_end = output.index(b"\n", position)
+        size = int(output[position:header_end].split()[2])
+        texts.append(output[header_end + 1:header_end + 1 + size].decode("utf-8", "replace"))
+        position = header_end + 1 + size + 1
+    return texts
+
+# Change date formatter
+def format_change(change: List[Any]) -> str:
+    """Describe a [timestamp, commit, subject] change record."""
+    return f"{time.strftime('%Y-%m-%d', time.gmtime(change[0]))} ({change[1][:7]} \"{change[2]}\")"
+
+# Persisted index of when pages and the code they refer to last changed
+class StalenessIndex:
+    """
+    The last commit to touch every tracked path, and the code paths each
+    documentation page refers to, as of the PR's base commit.
+
+    Only commits since the last indexed base are read from git log, and only
+    pages whose blob changed are scanned for references again. The facts about
+    each page are precomputed on refresh, so looking them up is a dict access.
+    """
+
+    def __init__(self, path: str, root: str, is_page: Callable[[str], bool]) -> None:
+        self.path = path
+        self.root = root
+        self.is_page = is_page
+        self.lock = threading.Lock()
+        self.head: Optional[str] = None
+        self.changes: Dict[str, List[Any]] = {}
+        self.pages: Dict[str, Dict[str, Any]] = {}
+        self.facts: Dict[str, List[Tuple[bool, str]]] = {}
+        self.directories: Dict[str, List[Any]] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.head, self.changes, self.pages = data["head"], data["changes"], data["pages"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ Ignoring unreadable staleness index {path}: {e}")
+
+    def refresh(self, head: str) -> None:
+        """Bring the index up to date with a commit and precompute the facts about each page."""
+        # A symbolic name such as HEAD would look unchanged on the next refresh
+        head = run_git(self.root, "rev-parse", "--verify", f"{head}^{{commit}}").strip()
+        if self.head and self.head != head:
+            try:
+                run_git(self.root, "merge-base", "--is-ancestor", self.head, head)
+            except subprocess.CalledProcessError:
+                self.head, self.changes = None, {}  # history was rewritten; start over
+        if self.head != head:
+            log = run_git(self.root, "log", "--reverse", "--no-renames", "--name-only",
+                          "--format=%x00%H%x09%ct%x09%s", f"{self.head}..{head}" if self.head else head)
+            for record in log.split("\x00")[1:]:
+                header, *paths = record.strip("\n").split("\n")
+                commit, timestamp, subject = header.split("\t", 2)
+                for changed_path in filter(None, paths):
+                    self.changes[changed_path] = [int(timestamp), commit, subject]
+            self.head = head
+
+        # Tracked files at the commit, and the directories holding code
+        tree = {}
+        for line in run_git(self.root, "ls-tree", "-r", head).splitlines():
+            info, _, tracked_path = line.partition("\t")
+            tree[tracked_path] = info.split()[2]
+        code_paths = {tracked_path for tracked_path in tree if not self.is_page(tracked_path)}
+        directories: Dict[str, List[Any]] = {}
+        names: Dict[str, List[str]] = {}
+        for code_path in code_paths:
+            names.setdefault(os.path.basename(code_path), []).append(code_path)
+            change = self.changes.get(code_path)
+            directory = os.path.dirname(code_path)
+            while directory and change:
+                if directory + "/" not in directories or directories[directory + "/"][0] < change[0]:
+                    directories[directory + "/"] = change
+                directory = os.path.dirname(directory)
+
+        # Rescan the pages whose content changed
+        pages = {tracked_path: self.pages.get(tracked_path) for tracked_path in tree if self.is_page(tracked_path)}
+        stale = [page_path for page_path, page in pages.items() if page is None or page['blob'] != tree[page_path]]
+        for page_path, text in zip(stale, read_git_blobs(self.root, [tree[page_path] for page_path in stale])):
+            pages[page_path] = {'blob': tree[page_path],
+                                'references': find_code_references(page_path, text, code_paths, directories, names)}
+        print(f"Indexed the history of {len(pages)} pages at {head[:7]} ({len(stale)} rescanned)")
+
+        # Facts about each page, references that changed after the page first
+        page_facts = {}
+        for page_path, page in pages.items():
+            touched = self.changes.get(page_path)
+            if touched is None:
+                continue
+            facts = [(False, f"- {page_path} was last changed {format_change(touched)}")]
+            for reference in page['references']:
+                changed = self.changes.get(reference) or directories.get(reference)
+                if changed is None:
+                    continue
+                if changed[0] > touched[0]:
+                    facts.append((True, f"- It refers to {reference}, which changed after it, {format_change(changed)}"))
+                else:
+                    facts.append((False, f"- It refers to {reference}, last changed {format_change(changed)}"))
+            page_facts[page_path] = facts[:1] + sorted(facts[1:], key=lambda fact: not fact[0])
+
+        # Swapped in together, so reviews running alongside never see a half-built index
+        self.pages, self.facts, self.directories = pages, page_facts, directories
+
+    def save(self) -> None:
+        """Write the history and page references back to disk."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({'head': self.head, 'changes': self.changes, 'pages': self.pages}, f)
+
+    def chunk_facts(self, file_path: str, chunk: Dict[str, Any], max_facts: int) -> List[str]:
+        """List when the page and the code it refers to last changed, and the code the chunk itself mentions."""
+        facts = [fact for _, fact in self.facts.get(file_path, [])]
+        known = set(self.pages.get(file_path, {}).get('references', []))
+        for line in chunk_added_text(chunk):
+            for token in PATH_TOKEN_RE.findall(line):
+                reference = token.strip("./")
+                if reference + "/" in self.directories:
+                    reference += "/"
+                changed = self.changes.get(reference) or self.directories.get(reference)
+                if changed and reference not in known:
+                    known.add(reference)
+                    facts.append(f"- This chunk mentions {reference}, last changed {format_change(changed)}")
+        return facts[:max_facts]
+
+# Code reference finder
+def find_code_references(page_path: str, text: str, code_paths: set, directories: Dict[str, List[Any]],
+                         names: Dict[str, List[str]]) -> List[str]:
+    """Return the tracked code files and directories a page mentions, by path or by unique file name."""
+    references = []
+    candidates = PATH_TOKEN_RE.findall(text) + [resolve_link(page_path, target)
+                                                for target in MARKDOWN_LINK_RE.findall(text)
+                                                if not URL_SCHEME_RE.match(target)]
+    for token in candidates:
+        token = token.partition("#")[0].strip("./")
+        if token in code_paths:
+            reference = token
+        elif token + "/" in directories:
+            reference = token + "/"
+        elif len(names.get(token, [])) == 1:
+            reference = names[token][0]
+        else:
+            continue
+        if reference not in references:
+            references.append(reference)
+    return references
+
+# Staleness indexes by path, loaded once per process
+staleness_indexes: Dict[str, StalenessIndex] = {}
+
+# Staleness index grabber
+def get_staleness_index(config: Dict[str, Any], pr_details: Dict[str, Any]) -> Optional[StalenessIndex]:
+    """Return the configured staleness index, brought up to date with the PR's base commit."""
+    staleness = config["staleness"]
+    if not staleness["enabled"]:
+        return None
+    if staleness["path"] not in staleness_indexes:
+        staleness_indexes[staleness["path"]] = StalenessIndex(
+            staleness["path"], os.environ.get("GITHUB_WORKSPACE", "."),
+            build_path_filter(config["docs_index"]["include"], config["docs_index"]["exclude"]))
+    index = staleness_indexes[staleness["path"]]
+    with index.lock:
+        try:
+            index.refresh(pr_details['base_sha'] or "HEAD")
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"⚠️ Could not read the git history, Chronos reviews without it: {e}")
+            return None
+        index.save()
+    return index
+
+# Repository context builder
+def build_repository_context(docs_index: Optional[DocsIndex], staleness_index: Optional[StalenessIndex],
+                             roster: List[Dict[str, str]], file_path: str, chunk: Dict[str, Any],
+                             config: Dict[str, Any]) -> str:
+    """Collect the index facts for the deities on a chunk's roster who can use them."""
+    names = {deity["name"] for deity in roster}
+    file_path = re.sub(r"^b/", "", file_path)
+    sections = []
+    if docs_index and "Demeter" in names:
+        facts = docs_index.terminology_facts(chunk, config["docs_index"]["max_terms"])
+        if facts:
+            sections.append("For Demeter, terms in this chunk that the documentation spells inconsistently:\n"
+                            + "\n".join(facts))
+    if docs_index and "Heracles" in names:
+        facts = docs_index.link_facts(file_path, chunk, config["docs_index"]["max_links"])
+        if facts:
+            sections.append(f"For Heracles, links to and from {file_path} (paths relative to it):\n"
+                            + "\n".join(facts))
+    if staleness_index and "Chronos" in names:
+        facts = staleness_index.chunk_facts(file_path, chunk, config["staleness"]["max_facts"])
+        if facts:
+            sections.append("For Chronos, the git history before this pull request:\n" + "\n".join(facts))
+    return "\n\n".join(sections)
+
+##############################
+# Pull request summarization
+##############################
+
+# Where the PR summary is filed among general comments
+PR_SUMMARY_PATH = "this pull request"
+
+# System message for merging digests; a deity's review persona would add its own sign-off
+DIGEST_SYSTEM_MESSAGE = """You are {name}, who condenses the divine pantheon's documentation reviews.
+You reply with exactly one JSON object and nothing before or after it."""
+
+# Instructions for merging digests
+DIGEST_INSTRUCTIONS = """Below are JSON digests of the divine reviews of parts of {scope}.
+Merge them into one digest of {scope} as a whole: bring out patterns and the most important
+problems, merge findings that say the same thing, and drop trivia.
+
+Reply with JSON only, in this form, with at most {max_findings} findings:
+{{"summary": "<two or three sentences>", "findings": ["<finding, naming file and line where known>"]}}
+
+Digests:
+{digests}
+"""
+
+# Score extractor
+def extract_scores(general_comments: List[Dict]) -> List[int]:
+    """Return the SCORE: values the deities gave in their general reviews, leaving out Atropos's AVERAGE SCORE:."""
+    return [int(score) for comment in general_comments
+            for score in re.findall(r"(?<!AVERAGE )SCORE:\s*(\d+)", comment['body'])]
+
+# Chunk digest builder
+def build_chunk_digest(file_data: Dict[str, Any], inline_comments: List[Dict], general_comments: List[Dict],
+                       summary: Dict[str, Any]) -> Dict[str, Any]:
+    """Condense one chunk's reviews into a compact digest, without a model call."""
+    shorten = lambda text: textwrap.shorten(text, width=200, placeholder="...")
+    lines = [change['ln'] for change in file_data['chunk']['changes']] or [0]
+    findings = ([f"{comment['deity']}, line {comment['lineNumber']}: {shorten(comment['body'])}"
+                 for comment in inline_comments] +
+                [f"{comment['deity']}: {shorten(comment['body'])}" for comment in general_comments])
+    scores = extract_scores(general_comments)
+    return {
+        'scope': f"{re.sub(r'^b/', '', file_data['to'])} lines {min(lines)}-{max(lines)}",
+        'path': re.sub(r'^b/', '', file_data['to']),
+        'also_in': len(file_data.get('duplicates', [])),
+        'summary': "",
+        'findings': findings[:2 * summary["max_findings"]],
+        'score': round(sum(scores) / len(scores)) if scores else None,
+    }
+
+# Digest merger
+async def merge_digests(client: ChatCompletionClient, system_message: str, scope: str,
+                        digests: List[Dict[str, Any]], summary: Dict[str, Any],
+                        model_calls: asyncio.Semaphore) -> Dict[str, Any]:
+    """Merge a group of digests into one with a model call, falling back to plain concatenation."""
+    scores = [digest['score'] for digest in digests if digest.get('score') is not None]
+    merged = {
+        'scope': scope,
+        'summary': " ".join(digest['summary'] for digest in digests if digest['summary']),
+        'findings': [finding for digest in digests for finding in digest['findings']][:summary["max_findings"]],
+        # Scores are averaged here rather than left to the model
+        'score': round(sum(scores) / len(scores)) if scores else None,
+    }
+
+    prompt = DIGEST_INSTRUCTIONS.format(
+        scope=scope, max_findings=summary["max_findings"],
+        digests=json.dumps([{key: digest[key] for key in ('scope', 'summary', 'findings')} for digest in digests]))
+    try:
+        async with model_calls:
+            result = await client.create([SystemMessage(content=system_message),
+                                          UserMessage(content=prompt, source="user")])
+        # Tolerate prose or a code fence around the JSON object
+        content = result.content.strip()
+        reply, _ = json.JSONDecoder().raw_decode(content[content.index("{"):])
+        merged['summary'] = str(reply['summary'])
+        merged['findings'] = [str(finding) for finding in reply['findings']][:summary["max_findings"]]
+    except Exception as e:
+        print(f"⚠️ Could not merge the digests of {scope}, concatenating them instead: {e}")
+    return merged
+
+# Digest reducer
+async def reduce_digests(client: ChatCompletionClient, system_message: str, scope: str,
+                         digests: List[Dict[str, Any]], summary: Dict[str, Any],
+                         model_calls: asyncio.Semaphore) -> Dict[str, Any]:
+    """Merge digests fan_in at a time, level by level, until one digest of the scope is left."""
+    while len(digests) > 1:
+        groups = [digests[i:i + summary["fan_in"]] for i in range(0, len(digests), summary["fan_in"])]
+        digests = await asyncio.gather(*[
+            merge_digests(client, system_message, scope, group, summary, model_calls) if len(group) > 1
+            else asyncio.sleep(0, group[0])
+            for group in groups])
+    return dict(digests[0], scope=scope)
+
+# Pull request summarizer
+async def summarize_pull_request(chunk_digests: List[Dict[str, Any]], config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reduce per-chunk digests to a digest of each file, then of each directory,
+    then of the whole PR. Returns the PR digest, with the directory digests
+    under 'parts'.
+    """
+    summary = config["summary"]
+    deity = next(deity for deity in PANTHEON if deity["name"] == summary["deity"])
+    backend_name = get_deity_backend(config, deity["name"])
+    client = InstrumentedChatCompletionClient(model_clients[backend_name], deity["name"],
+                                              get_backend_model(config["backends"][backend_name]))
+    system_message = DIGEST_SYSTEM_MESSAGE.format(name=deity["name"])
+    # Merges of a level run side by side, but never more than this many model calls at once
+    model_calls = asyncio.Semaphore(summary["max_concurrent_merges"])
+
+    async def reduce_groups(digests: List[Dict[str, Any]], key: Callable) -> List[Dict[str, Any]]:
+        groups = {}
+        for digest in digests:
+            groups.setdefault(key(digest), []).append(digest)
+        return await asyncio.gather(*[
+            reduce_digests(client, system_message, scope, group, summary, model_calls)
+            for scope, group in groups.items()])
+
+    file_digests = await reduce_groups(chunk_digests, lambda digest: digest['path'])
+    for digest in file_digests:
+        digest['path'] = digest['scope']
+    directory_digests = await reduce_groups(file_digests, lambda digest: (os.path.dirname(digest['path']) or ".") + "/")
+    pr_digest = await reduce_digests(client, system_message, PR_SUMMARY_PATH, directory_digests, summary, model_calls)
+    return dict(pr_digest, parts=directory_digests)
+
+# Summary formatter
+def format_pr_summary(pr_digest: Dict[str, Any]) -> str:
+    """Render the PR digest as the body of a general comment."""
+    body = pr_digest['summary'] or "The pantheon's findings across this pull request:"
+    if pr_digest['findings']:
+        body += "\n\n**Key findings**\n" + "\n".join(f"- {finding}" for finding in pr_digest['findings'])
+    if pr_digest['score'] is not None:
+        body += f"\n\n**Overall SCORE: {pr_digest['score']}**"
+    if len(pr_digest['parts']) > 1:
+        body += "\n\n<details><summary>By directory</summary>\n\n"
+        for part in pr_digest['parts']:
+            score = f" (SCORE: {part['score']})" if part['score'] is not None else ""
+            body += f"- `{part['scope']}`{score}: {part['summary'] or '; '.join(part['findings'][:2])}\n"
+        body += "\n</details>"
+    return body
+
+##################
+# Sharded runs
+##################
+
+# Shard argument parser
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a --shard argument such as 2/4 into (index, count)."""
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or int(match[1]) >= int(match[2]):
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT with 0 <= INDEX < COUNT, got {value!r}")
+    return int(match[1]), int(match[2])
+
+# Shard assignment
+def get_shard(path: str, shard_count: int) -> int:
+    """Assign a file to a shard by a stable hash of its path, so every job agrees."""
+    return int.from_bytes(hashlib.sha256(path.encode()).digest()[:8], "big") % shard_count
+
+# Shard selector
+def select_shard(parsed_files: List[Dict[str, Any]], shard: Tuple[int, int]) -> List[Dict[str, Any]]:
+    """Keep the chunks of files in this shard; duplicates travel with their representative."""
+    shard_index, shard_count = shard
+    selected = [file_data for file_data in parsed_files if get_shard(file_data['to'], shard_count) == shard_index]
+    print(f"Shard {shard_index + 1} of {shard_count}: reviewing {len(selected)} of {len(parsed_files)} chunks")
+    return selected
+
+# Shard result writer
+def write_shard_results(path: str, inline_comments: List[Dict], general_comments: List[Dict],
+                        notices: List[str], reviewed_scopes: Optional[set] = None) -> None:
+    """Write a shard's comments, notices and reviewed scopes as JSON lines, for the merge job to post."""
+    with open(path, "w", encoding="utf-8") as f:
+        for comment in inline_comments:
+            f.write(json.dumps(dict(comment, kind="inline")) + "\n")
+        for comment in general_comments:
+            f.write(json.dumps(dict(comment, kind="general")) + "\n")
+        for notice in notices:
+            f.write(json.dumps({"kind": "notice", "body": notice}) + "\n")
+        for scope in sorted(reviewed_scopes or (), key=str):
+            f.write(json.dumps(dict(zip(("path", "first", "last", "deity"), scope), kind="reviewed")) + "\n")
+    print(f"Wrote {len(inline_comments)} inline and {len(general_comments)} general comments to {path}")
+
+# Shard result reader
+def read_shard_results(paths: List[str]) -> Tuple[List[Dict], List[Dict], List[str], set]:
+    """Read every shard's results, dropping records repeated across shards or job retries."""
+    results = {"inline": [], "general": [], "notice": [], "reviewed": []}
+    seen = set()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                key = json.dumps(record, sort_keys=True)
+                if key in seen:
+                    continue
+                seen.add(key)
+                kind = record.pop("kind")
+                if kind == "notice":
+                    results[kind].append(record["body"])
+                elif kind == "reviewed":
+                    results[kind].append((record["path"], record["first"], record["last"], record["deity"]))
+                else:
+                    results[kind].append(record)
+    return results["inline"], results["general"], results["notice"], set(results["reviewed"])
+
+# Shard result merger
+def merge_shard_results(config: Dict[str, Any], result_paths: List[str]) -> None:
+    """Post the results of every shard job to the PR, with one post_comments_to_pr call."""
+    pr_details = load_pr_context(repository, pr_number, github_token)
+
+    # Diff positions are rebuilt from the diff, which is cheap next to the review
+    position_index = {}
+    parse_diff(get_diff(pr_details),
+               exclude_patterns=config["exclude"],
+               include_patterns=config["include"],
+               position_index=position_index)
+
+    if config["coalesce"]["enabled"] and is_superseded(pr_details):
+        return
+
+    inline_comments, general_comments, notices, reviewed_scopes = read_shard_results(result_paths)
+    print(f"Merged {len(inline_comments)} inline and {len(general_comments)} general comments "
+          f"from {len(result_paths)} shards")
+    if config["posting"]["incremental"]:
+        try:
+            pr_details['posted_comments'] = load_posted_comments(pr_details)
+        except Exception as e:
+            print(f"⚠️ Could not list earlier comments, posting all comments: {e}")
+    for notice in notices:
+        post_notice(pr_details, notice)
+    post_comments_to_pr(pr_details, inline_comments, general_comments, position_index)
+    if config["posting"]["incremental"]:
+        minimize_stale_comments(pr_details, reviewed_scopes | {NOTICE_SCOPE})
 
 #############################
 # Helper function definitions
 #############################
 
+# Actions event payload loader
+@functools.lru_cache(maxsize=1)
+def load_event_payload() -> Dict[str, Any]:
+    """Load the webhook payload of the event that triggered the workflow, if any."""
+    event_path = os.environ.get("GITHUB_EVENT_PATH")
+    if not event_path or not os.path.isfile(event_path):
+        return {}
+    with open(event_path, encoding="utf-8") as f:
+        return json.load(f)
+
 # PR grabber
-def get_pr_details(repository: str, pr_number: int, github_token: str) -> Dict[str, Any]:
+def get_pr_details(repository: str, pr_number: int, github_token: str,
+                   event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """Extract PR details from the GitHub repository."""
     # Initialize GitHub client
-    github_client = Github(github_token)
+    github_client = get_github_client(github_token)
     
     # Get repository and PR objects
     repo_obj = github_client.get_repo(repository)
@@ -448,6 +2706,13 @@ def get_pr_details(repository: str, pr_number: int, github_token: str) -> Dict[s
     
     # Split repository name to get owner and repo
     owner, repo = repository.split('/')
+
+    # Prefer the head SHA the event was raised for; the PR object already carries it otherwise
+    event_pr = (load_event_payload() if event is None else event).get("pull_request") or {}
+    if event_pr.get("number") == pr_number:
+        head_sha = event_pr["head"]["sha"]
+    else:
+        head_sha = pr.head.sha
     
     return {
         'owner': owner,
@@ -455,15 +2720,94 @@ def get_pr_details(repository: str, pr_number: int, github_token: str) -> Dict[s
         'pull_number': pr_number,
         'title': pr.title,
         'description': pr.body or '',
+        'url': pr.url,
+        'head_sha': head_sha,
+        'base_sha': pr.base.sha,
+        'changed_files': pr.changed_files,
         'repo_obj': repo_obj,
         'pr_obj': pr,
         'github_token': github_token
     }
 
+# PR context loader
+def load_pr_context(repository: str, pr_number: Optional[int], github_token: str,
+                    event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Build the PR details for this run, reading the event payload first.
+
+    On pull_request events the payload already holds every field, so no API call
+    is made. The API is only asked for fields the payload lacks, as on
+    workflow_dispatch runs. The payload is the Actions event unless one is given.
+    """
+    event_pr = (load_event_payload() if event is None else event).get("pull_request") or {}
+    if event_pr.get("number") is None or pr_number not in (None, event_pr["number"]):
+        event_pr = {}
+
+    owner, repo = repository.split('/')
+    pr_details = {
+        'owner': owner,
+        'repo': repo,
+        'pull_number': event_pr.get('number', pr_number),
+        'title': event_pr.get('title'),
+        'description': (event_pr.get('body') or '') if event_pr else None,
+        'url': event_pr.get('url'),
+        'head_sha': (event_pr.get('head') or {}).get('sha'),
+        'base_sha': (event_pr.get('base') or {}).get('sha'),
+        'changed_files': event_pr.get('changed_files'),
+        'repo_obj': None,
+        'pr_obj': None,
+        'github_token': github_token
+    }
+
+    if pr_details['pull_number'] is None:
+        raise ValueError("No PR number was given and the triggering event is not a pull request")
+
+    missing = [key for key, value in pr_details.items() if value is None and not key.endswith('_obj')]
+    if missing:
+        print(f"Fetching {', '.join(missing)} for PR #{pr_details['pull_number']} from the GitHub API")
+        api_details = get_pr_details(repository, pr_details['pull_number'], github_token, event)
+        for key in missing + ['repo_obj', 'pr_obj']:
+            pr_details[key] = api_details[key]
+
+    return pr_details
+
+# GitHub client grabber
+@functools.lru_cache(maxsize=None)
+def get_github_client(github_token: str) -> Github:
+    """Return one GitHub client per token, so its connection pool is reused across PRs."""
+    # Lazy objects make no API call until an attribute they do not hold is read
+    return Github(github_token, lazy=True)
+
+# PR object grabber
+def get_pr_objects(pr_details: Dict[str, Any]) -> Tuple[Any, Any]:
+    """Return the PyGithub repository and pull request objects, creating them on first use."""
+    if pr_details['pr_obj'] is None:
+        github_client = get_github_client(pr_details['github_token'])
+        pr_details['repo_obj'] = github_client.get_repo(f"{pr_details['owner']}/{pr_details['repo']}")
+        pr_details['pr_obj'] = pr_details['repo_obj'].get_pull(pr_details['pull_number'])
+    return pr_details['repo_obj'], pr_details['pr_obj']
+
+# PR head freshness check
+def is_superseded(pr_details: Dict[str, Any]) -> bool:
+    """Tell whether the PR head has moved past the commit this run is reviewing."""
+    try:
+        github_client = get_github_client(pr_details['github_token'])
+        pull_request = github_client.get_repo(f"{pr_details['owner']}/{pr_details['repo']}").get_pull(
+            pr_details['pull_number'])
+        head_sha = pull_request.head.sha
+    except Exception as e:
+        print(f"⚠️ Could not check the PR head, carrying on: {e}")
+        return False
+
+    if head_sha != pr_details['head_sha']:
+        print(f"PR head moved from {pr_details['head_sha'][:7]} to {head_sha[:7]}; dropping this review")
+        return True
+    return False
+
 # PR diff grabber    
 def get_diff(pr_details: Dict[str, Any], event_data: Dict[str, Any] = None) -> str:
     """Fetch the diff content using the GitHub API with Accept header."""
-    pr_url = pr_details["pr_obj"].url
+    pr_url = pr_details["url"]
     token = pr_details["github_token"]
 
     headers = {
@@ -477,12 +2821,45 @@ def get_diff(pr_details: Dict[str, Any], event_data: Dict[str, Any] = None) -> s
 
     return response.text
 
+# Per-file diff splitter
+def split_diff_by_file(diff_content: str) -> List[Tuple[Optional[str], List[str]]]:
+    """Split a unified diff into per-file sections, keyed by the new path (None for deleted files)."""
+    sections = []
+    in_header = False
+    for line in diff_content.splitlines():
+        if line.startswith("diff --git ") or not sections:
+            sections.append([None, []])
+            in_header = True
+        elif line.startswith("@@"):
+            in_header = False
+
+        # The "+++" header names the new path; inside hunks it is just an added line
+        if in_header and line.startswith("+++ "):
+            target = line[4:].split("\t")[0]
+            sections[-1][0] = None if target == "/dev/null" else re.sub(r"^b/", "", target)
+        sections[-1][1].append(line)
+
+    return [(path, lines) for path, lines in sections]
+
 # PR diff parser
-def parse_diff(diff_content: str, exclude_patterns: List[str] = None) -> List[Dict[str, Any]]:
-    exclude_patterns = exclude_patterns or []
+def parse_diff(diff_content: str, exclude_patterns: List[str] = None,
+               include_patterns: List[str] = None,
+               position_index: Optional[Dict[str, Dict[int, int]]] = None) -> List[Dict[str, Any]]:
+    """
+    Parse the diff content into files and chunks.
+
+    When a position_index dict is given, it is filled with a
+    {path: {new_line: diff_position}} map of every commentable line.
+    """
+    path_filter = build_path_filter(include_patterns or ["**"], exclude_patterns or [])
+
+    # Drop deleted, excluded, generated and vendored files before unidiff builds any hunk objects
+    selected_lines = []
+    for path, lines in split_diff_by_file(diff_content):
+        if path is not None and path_filter(path):
+            selected_lines.extend(lines)
 
-    """Parse the diff content into files and chunks."""
-    patch_set = unidiff.PatchSet(diff_content.splitlines())
+    patch_set = unidiff.PatchSet(selected_lines)
     parsed_files = []
     
     for patched_file in patch_set:
@@ -491,61 +2868,149 @@ def parse_diff(diff_content: str, exclude_patterns: List[str] = None) -> List[Di
             continue
             
         file_path = patched_file.target_file
-        
-        # Check if file should be excluded
-        if any(glob.fnmatch.fnmatch(file_path, pattern) for pattern in exclude_patterns):
-            continue
+        file_positions = {}
+        if position_index is not None:
+            position_index[patched_file.path] = file_positions
+
+        # Diff positions count every line below the file's first hunk header,
+        # including removed lines and the headers of later hunks
+        position = 0
             
-        for hunk in patched_file:
+        for hunk_number, hunk in enumerate(patched_file):
             chunk_header = f"@@ -{hunk.source_start},{hunk.source_length} +{hunk.target_start},{hunk.target_length} @@"
+            if hunk_number:
+                position += 1
 
             changes = []
+            removed = []
             for line in hunk:
+                position += 1
                 if line.is_added or line.is_context:
                     line_num = line.target_line_no
+                    file_positions[line_num] = position
                     changes.append({
                         'ln': line_num,
                         'content': str(line)
                     })
+                elif line.is_removed:
+                    removed.append(str(line))
             
             parsed_files.append({
                 'to': file_path,
                 'chunk': {
                     'content': chunk_header,
-                    'changes': changes
+                    'changes': changes,
+                    'removed': removed
                 }
             })
             
     return parsed_files
 
 # PR diff position getter
-def get_diff_position(patch: str, target_line: int) -> Optional[int]:
+def get_diff_position(position_index: Dict[str, Dict[int, int]], path: str, target_line: int) -> Optional[int]:
     """
-    Given a patch string and a target line number in the new file,
-    return the position (index of the line in the diff) suitable for GitHub API.
+    Given the position index built by parse_diff, a file path and a line number
+    in the new file, return the position in the diff suitable for the GitHub API.
     """
-    if not patch:
-        return None
+    if path.startswith("b/"):
+        path = path[2:]
+    return position_index.get(path, {}).get(target_line)
 
-    diff_lines = patch.split('\n')
-    position = 0
-    new_line_number = 0
+# Local checkout file reader
+@functools.lru_cache(maxsize=64)
+def read_checkout_lines(path: str, head_sha: str) -> Tuple[str, ...]:
+    """
+    Read a file from the local checkout of the PR head, or return nothing if it
+    is unavailable. The head only keys the cache, so a new head reads afresh.
+    """
+    local_path = os.path.join(os.environ.get("GITHUB_WORKSPACE", "."), path)
+    try:
+        with open(local_path, encoding="utf-8") as f:
+            return tuple(f.read().splitlines())
+    except (OSError, UnicodeDecodeError):
+        return ()
+
+# Local checkout line reader
+def read_checkout_line(path: str, line_number: int, head_sha: str) -> Optional[str]:
+    """Return one line (1-based) of a file in the local checkout of head_sha, if it exists."""
+    lines = read_checkout_lines(path, head_sha)
+    if 0 < line_number <= len(lines):
+        return lines[line_number - 1]
+    return None
 
-    for line in diff_lines:
-        if line.startswith('@@'):
-            m = re.match(r'^@@ \-(\d+),?\d* \+(\d+),?\d* @@', line)
-            if not m:
-                continue
-            new_line_number = int(m.group(2)) - 1  # GitHub line numbers are 1-based
-        elif not line.startswith('-'):
-            new_line_number += 1
+# Inline review converter
+def to_inline_comment(deity_name: str, inline: Dict[str, Any]) -> Dict[str, Any]:
+    """Turn one inlineReviews entry of a deity's reply into an inline comment."""
+    return {
+        "deity": deity_name,
+        "filename": inline.get("filename", "unknown"),
+        "lineNumber": inline.get("lineNumber", 1),
+        "body": inline.get("reviewComment", "").strip()
+    }
 
-        position += 1
+# Streaming JSON parser
+class InlineReviewStreamParser:
+    """
+    Pick complete inlineReviews entries out of a deity's reply while it streams in.
 
-        if new_line_number == target_line:
-            return position
+    Tracks string, object and array nesting one character at a time, so each
+    entry is handed out as soon as its closing brace arrives, long before the
+    rest of the reply. Anything that does not parse is left for the final parse.
+    """
 
-    return None
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._position = 0
+        self._stack: List[Tuple[str, Optional[str]]] = []  # open containers and the key they belong to
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._pending_key: Optional[str] = None
+        self._entry_start: Optional[int] = None
+
+    def _in_inline_reviews(self) -> bool:
+        return len(self._stack) == 2 and self._stack[0][0] == "{" and self._stack[1] == ("[", "inlineReviews")
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """Add streamed text and return the inline review entries it completed."""
+        self._buffer += text
+        entries = []
+        while self._position < len(self._buffer):
+            char = self._buffer[self._position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = self._buffer[self._string_start + 1:self._position]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = self._position
+            elif char == ":":
+                self._pending_key = self._last_string
+            elif char == ",":
+                self._pending_key = None
+            elif char in "{[":
+                if char == "{" and self._in_inline_reviews():
+                    self._entry_start = self._position
+                key = self._pending_key if self._stack and self._stack[-1][0] == "{" else None
+                self._stack.append((char, key))
+                self._pending_key = None
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if char == "}" and self._entry_start is not None and self._in_inline_reviews():
+                    try:
+                        entry = json.loads(self._buffer[self._entry_start:self._position + 1])
+                        if isinstance(entry, dict):
+                            entries.append(entry)
+                    except json.JSONDecodeError:
+                        pass
+                    self._entry_start = None
+            self._position += 1
+        return entries
 
 # JSON parser
 def parse_task_result_for_reviews(task_result):
@@ -571,12 +3036,7 @@ def parse_task_result_for_reviews(task_result):
             continue
 
         for inline in data.get("inlineReviews", []):
-            all_inline_comments.append({
-                "deity": deity_name,
-                "filename": inline.get("filename", "unknown"),
-                "lineNumber": inline.get("lineNumber", 1),
-                "body": inline.get("reviewComment", "").strip()
-            })
+            all_inline_comments.append(to_inline_comment(deity_name, inline))
 
         for general in data.get("generalReviews", []):
             all_general_comments.append({
@@ -587,48 +3047,243 @@ def parse_task_result_for_reviews(task_result):
 
     return all_inline_comments, all_general_comments
 
-# Github PR comment poster
-def post_comments_to_pr(repo_name: str, pr_number: int, github_token: str, 
-                         inline_comments: List[Dict], general_comments: List[Dict]) -> None:
+# GitHub I/O offloader
+async def run_github_io(executor: concurrent.futures.Executor, func: Callable, *args, **kwargs) -> Any:
+    """Run a blocking GitHub call on the bounded I/O thread pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    record_run('github_calls', {'call': func.__name__, 'args': args[1:], 'kwargs': kwargs})
+    with telemetry_span(func.__name__, "github"):
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+# Streamed review reader
+async def stream_inline_reviews(stream, file_data: Dict[str, Any], queue: asyncio.Queue,
+                                streamed: List[Dict]):
     """
-    Posts comments to the GitHub PR.
-    
-    Args:
-        repo_name: The name of the repository in the format 'owner/repo'
-        pr_number: The PR number to post comments to
-        github_token: GitHub token for authentication
-        inline_comments: List of inline comments to post
-        general_comments: List of general comments to post
+    Pass a team's message stream through, queueing each inline comment for
+    posting as soon as its JSON object has streamed in. Queued comments are
+    also recorded in `streamed` so the final parse does not post them again.
+    """
+    parsers: Dict[str, InlineReviewStreamParser] = {}
+    async for item in stream:
+        if isinstance(item, ModelClientStreamingChunkEvent):
+            parser = parsers.setdefault(item.source, InlineReviewStreamParser())
+            comments = [to_inline_comment(item.source, entry) for entry in parser.feed(item.content)]
+            comments = drop_overlap_comments(file_data['chunk'], comments)
+            comments, _ = fan_out_duplicate_comments(file_data, comments, [])
+            for comment in comments:
+                queue.put_nowait(comment)
+            streamed.extend(comments)
+        elif isinstance(item, BaseChatMessage):
+            parsers.pop(item.source, None)  # the reply is complete; a later turn starts afresh
+        yield item
+
+# Streamed inline comment poster
+async def post_streamed_comments(executor: concurrent.futures.Executor, queue: asyncio.Queue,
+                                 pr_details: Dict[str, Any], position_index: Dict[str, Dict[int, int]],
+                                 check_head: bool = False) -> int:
+    """
+    Post inline comments from the queue until a None sentinel arrives.
+
+    Whatever has piled up while the previous review was being posted goes out
+    together as the next review, so a burst of comments costs one API call.
+    With check_head, each batch is only posted while the reviewed commit is
+    still the PR head. Returns the number of comments taken off the queue.
+    """
+    posted = 0
+    finished = False
+    superseded = False
+    while not finished:
+        batch = [await queue.get()]
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        finished = None in batch
+        batch = [comment for comment in batch if comment is not None]
+        if batch and check_head and not superseded:
+            superseded = await run_github_io(executor, is_superseded, pr_details)
+        if batch and not superseded:
+            await run_github_io(executor, post_comments_to_pr, pr_details, batch, [], position_index)
+        posted += len(batch)
+    return posted
+
+# Hidden marker of a posted comment: its key, line, deity and file.
+# Markers from older runs carry only the key and file.
+COMMENT_MARKER_RE = re.compile(
+    r"<!-- pantheon:(?P<key>[0-9a-f]{16}):(?:(?P<line>\d*):(?P<deity>[^:]*):)?(?P<path>.*?) -->")
+
+# Where notices about the run itself are filed among marked comments
+NOTICE_PATH = "this review run"
+# Every run reviews its own notices, whoever posted them
+NOTICE_SCOPE = (NOTICE_PATH, None, None, None)
+
+# Posted comment record from a marker
+def read_comment_marker(match: re.Match, node_id: Optional[str], current: bool) -> Dict[str, Any]:
+    return {'node_id': node_id, 'path': match["path"], 'current': current,
+            'line': int(match["line"]) if match["line"] else None, 'deity': match["deity"]}
+
+# Reviewed scope test
+def in_reviewed_scope(comment: Dict[str, Any], reviewed_scopes: set) -> bool:
+    """
+    Tell whether a posted comment falls within a (path, first line, last line,
+    deity) scope this run reviewed. A scope without lines covers the whole path
+    and one without a deity covers every deity. Comments from older markers,
+    which record no deity, are only covered by scopes without one.
+    """
+    for path, first, last, deity in reviewed_scopes:
+        if path != comment['path'] or deity not in (None, comment['deity']):
+            continue
+        if first is None or (comment['line'] is not None and first <= comment['line'] <= last):
+            return True
+    return False
+
+# Chunk scope builder
+def chunk_scopes(file_data: Dict[str, Any], deity_names: List[str]) -> set:
+    """
+    Return the scopes a review of a chunk covers: the lines of the chunk and of
+    each of its duplicates, for each deity that reviewed it. A window's overlap
+    lines belong to the previous window.
+    """
+    scopes = set()
+    for reviewed in [file_data] + file_data.get('duplicates', []):
+        overlap_lines = set(reviewed['chunk'].get('overlap_lines', ()))
+        lines = [change['ln'] for change in reviewed['chunk']['changes'] if change['ln'] not in overlap_lines]
+        if lines:
+            path = re.sub(r"^b/", "", reviewed['to'])
+            scopes.update((path, min(lines), max(lines), deity_name) for deity_name in deity_names)
+    return scopes
+
+# Posted comment indexer
+def load_posted_comments(pr_details: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Index the comments earlier runs posted on the PR by the key in their marker.
+
+    Review and issue comments are each listed once, so this costs one paginated
+    call per hundred comments, whatever the number of comments this run makes.
+    """
+    _, pull_request = get_pr_objects(pr_details)
+    posted = {}
+    for comment in pull_request.get_review_comments():
+        match = COMMENT_MARKER_RE.search(comment.body or "")
+        if match:
+            # Comments on lines no longer in the diff have no position and show as outdated
+            posted[match["key"]] = read_comment_marker(match, comment.node_id, comment.position is not None)
+    for comment in pull_request.get_issue_comments():
+        match = COMMENT_MARKER_RE.search(comment.body or "")
+        if match:
+            posted[match["key"]] = read_comment_marker(match, comment.node_id, True)
+    print(f"Found {len(posted)} comments from earlier reviews on the PR")
+    return posted
+
+# Comment claimer
+def claim_comment(pr_details: Dict[str, Any], path: str, line_number: Optional[int], deity_name: str,
+                  body: str, scope_line: Optional[int] = None) -> Optional[str]:
+    """
+    Register a comment this run makes and return the hidden marker to append to
+    it, or None when the same deity already made it on the same line. General
+    comments have no line; their marker records scope_line, the first line of
+    the chunk they came from, instead.
+    """
+    key = hashlib.sha256(f"{path}\n{line_number}\n{deity_name}\n{body}".encode()).hexdigest()[:16]
+    pr_details.setdefault('run_comment_keys', set()).add(key)
+
+    marker_line = line_number if line_number is not None else scope_line
+    posted = pr_details.get('posted_comments')
+    if posted is not None:
+        if key in posted and posted[key]['current']:
+            return None
+        posted[key] = {'node_id': None, 'path': path, 'current': True, 'line': marker_line, 'deity': deity_name}
+    return f"\n\n<!-- pantheon:{key}:{'' if marker_line is None else marker_line}:{deity_name}:{path} -->"
+
+# Stale comment minimizer
+def minimize_stale_comments(pr_details: Dict[str, Any], reviewed_scopes: set) -> None:
+    """
+    Hide earlier comments within the scopes reviewed in this run that this run
+    did not make again, as outdated, with one GraphQL request per fifty comments.
+    Comments on chunks or by deities the run skipped are left alone.
     """
+    posted = pr_details.get('posted_comments') or {}
+    run_keys = pr_details.get('run_comment_keys', set())
+    stale = [comment['node_id'] for key, comment in posted.items()
+             if key not in run_keys and comment['node_id'] and in_reviewed_scope(comment, reviewed_scopes)]
+    if not stale:
+        return
+
+    graphql_url = os.environ.get("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+    headers = {"Authorization": f"bearer {pr_details['github_token']}"}
+    for start in range(0, len(stale), 50):
+        mutations = " ".join(
+            f"m{i}: minimizeComment(input: {{subjectId: {json.dumps(node_id)}, classifier: OUTDATED}}) "
+            f"{{ minimizedComment {{ isMinimized }} }}"
+            for i, node_id in enumerate(stale[start:start + 50]))
+        try:
+            response = requests.post(graphql_url, json={"query": f"mutation {{ {mutations} }}"}, headers=headers)
+            response.raise_for_status()
+            errors = response.json().get("errors")
+            if errors:
+                print(f"⚠️ Some stale comments could not be minimized: {errors[0].get('message')}")
+        except Exception as e:
+            print(f"Error minimizing stale comments: {e}")
+            return
+    print(f"Minimized {len(stale)} stale comments from earlier reviews")
+
+# Github PR general comment poster
+def post_general_comments(pr_details: Dict[str, Any], general_comments: List[Dict]) -> None:
+    """Posts general comments to the GitHub PR as issue comments."""
     try:
-        # Initialize GitHub client
-        g = Github(github_token)
-        
-        # Get the repository and pull request
-        repo = g.get_repo(repo_name)
-        pull_request = repo.get_pull(pr_number)
+        _, pull_request = get_pr_objects(pr_details)
 
-        # --- Post General Comments ---
         for comment in general_comments:
             deity_name = comment["deity"]
             filename = comment["filename"]
             if filename.startswith("b/"):  # Normalize 'b/' prefix
                 filename = filename[2:]
             body = comment["body"]
-            full_comment = f"## {deity_name}'s Review of {filename}\n\n{body}"
+            marker = claim_comment(pr_details, filename, None, deity_name, body, comment.get("scopeLine"))
+            if marker is None:
+                print(f"General comment from {deity_name} for {filename} is already on the PR")
+                continue
+            full_comment = f"## {deity_name}'s Review of {filename}\n\n{body}{marker}"
             pull_request.create_issue_comment(full_comment)
             print(f"Posted general comment from {deity_name} for {filename}")
+
+    except Exception as e:
+        print(f"Error posting general comments to PR: {e}")
+
+# Github PR notice poster
+def post_notice(pr_details: Dict[str, Any], notice: str) -> None:
+    """Posts a notice about the review run itself to the GitHub PR."""
+    try:
+        _, pull_request = get_pr_objects(pr_details)
+        marker = claim_comment(pr_details, NOTICE_PATH, None, "Divine Pantheon", notice)
+        if marker is None:
+            print(f"Notice is already on the PR: {notice}")
+            return
+        pull_request.create_issue_comment(f"## Divine Pantheon Review\n\n{notice}{marker}")
+        print(f"Posted notice: {notice}")
+    except Exception as e:
+        print(f"Error posting notice to PR: {e}")
+
+# Github PR comment poster
+def post_comments_to_pr(pr_details: Dict[str, Any], inline_comments: List[Dict],
+                         general_comments: List[Dict],
+                         position_index: Dict[str, Dict[int, int]]) -> None:
+    """
+    Posts comments to the GitHub PR.
+    
+    Args:
+        pr_details: PR details from get_pr_details, shared with the rest of the run
+        inline_comments: List of inline comments to post
+        general_comments: List of general comments to post
+        position_index: Line to diff position index built by parse_diff
+    """
+    try:
+        # Reuse the repository and pull request objects shared by the whole run
+        repo, pull_request = get_pr_objects(pr_details)
+
+        # --- Post General Comments ---
+        post_general_comments(pr_details, general_comments)
         
         # --- Prepare Inline Comments ---
-        latest_commit = list(pull_request.get_commits())[-1]
-
-        # Normalize file names from the PR diff
-        files_changed = {}
-        for f in pull_request.get_files():
-            clean_name = f.filename
-            if clean_name.startswith("b/"):
-                clean_name = clean_name[2:]
-            files_changed[clean_name] = f
+        latest_commit = repo.get_commit(pr_details['head_sha'])
 
         # Group inline comments by filename
         comments_by_file = {}
@@ -641,34 +3296,41 @@ def post_comments_to_pr(repo_name: str, pr_number: int, github_token: str,
                 comments_by_file[filename] = []
             comments_by_file[filename].append(comment)
 
+        # Review comments can only target lines in the diff, so the parsed hunks
+        # are all that is needed to validate them
         review_comments = []
+        review_lines = []
+        skipped = 0
         for filename, comments in comments_by_file.items():
-            if filename not in files_changed:
+            if filename not in position_index:
                 print(f"File {filename} not found in pull request diff.")
                 continue
 
-            try:
-                file_content = repo.get_contents(filename, ref=pull_request.head.ref).decoded_content.decode('utf-8')
-                lines = file_content.split('\n')
-            except Exception as e:
-                print(f"Could not fetch file content for {filename}: {e}")
-                continue
-
             for comment in comments:
                 deity_name = comment["deity"]
                 line_number = comment["lineNumber"]
                 body = comment["body"]
 
-                if 0 < line_number <= len(lines):
-                    # GitHub API needs "position" in the diff, not line number
-                    # For simplicity, use line number directly if it works in your setup
-                    review_comments.append({
-                        "path": filename,
-                        "position": line_number,
-                        "body": f"**{deity_name}**: {body}"
-                    })
-                else:
-                    print(f"Line number {line_number} out of bounds for {filename}")
+                # GitHub API needs "position" in the diff, not line number
+                position = get_diff_position(position_index, filename, line_number)
+                if position is None:
+                    print(f"Line {line_number} of {filename} is not part of the diff")
+                    continue
+
+                marker = claim_comment(pr_details, filename, line_number, deity_name, body)
+                if marker is None:
+                    skipped += 1
+                    continue
+
+                review_comments.append({
+                    "path": filename,
+                    "position": position,
+                    "body": f"**{deity_name}**: {body}{marker}"
+                })
+                review_lines.append(line_number)
+
+        if skipped:
+            print(f"Skipped {skipped} inline comments that are already on the PR")
 
         # --- Post Inline Comments as Review ---
         if review_comments:
@@ -681,9 +3343,14 @@ def post_comments_to_pr(repo_name: str, pr_number: int, github_token: str,
                 print(f"Posted {len(review_comments)} inline comments to PR")
             except Exception as e:
                 print(f"Error posting review comments: {e}")
-                # Fallback to issue comments
-                for comment in review_comments:
-                    fallback = f"**Inline Comment for {comment['path']}:{comment['position']}**\n\n{comment['body']}"
+                # Fallback to issue comments, quoting the line since there is no diff context
+                for comment, line_number in zip(review_comments, review_lines):
+                    fallback = f"**Inline Comment for {comment['path']}:{line_number}**\n\n"
+                    quoted_line = pr_details.get('has_checkout') and \
+                        read_checkout_line(comment['path'], line_number, pr_details['head_sha'])
+                    if quoted_line:
+                        fallback += f"> {quoted_line}\n\n"
+                    fallback += comment['body']
                     pull_request.create_issue_comment(fallback)
 
     except Exception as e:
@@ -704,10 +3371,8 @@ def test_github_connection():
         pr = repo.get_pull(pr_number)
         print(f"PR exists. Title: {pr.title}")
         
-        # Try to list files in the PR
-        print("Attempting to list files in PR")
-        files = list(pr.get_files())
-        print(f"PR contains {len(files)} files")
+        # The file count comes with the PR, no need to page through the file list
+        print(f"PR contains {pr.changed_files} files")
         
         return True
     except Exception as e:
@@ -719,137 +3384,618 @@ def test_github_connection():
 # Python functions
 ####################
 
+# PR review pipeline
+async def review_pull_request(config: Dict[str, Any], event: Optional[Dict[str, Any]] = None,
+                              shard: Optional[Tuple[int, int]] = None,
+                              shard_results_path: Optional[str] = None) -> None:
+    """
+    Fetch, parse, review and post comments for one PR, recording a span for each stage.
+
+    The PR is the one in the given webhook payload, or else the one this
+    Actions run was started for. With a shard, only that shard's files are
+    reviewed, and the comments are written to shard_results_path for
+    merge_shard_results instead of posted.
+    """
+    run_started = time.monotonic()
+    shard_notices = []
+    if shard:
+        # Start with an empty results file, so the merge job finds one even if nothing is reviewed
+        write_shard_results(shard_results_path, [], [], [])
+
+    # Load the PR content, from the event payload where possible
+    event_repository = (event or {}).get("repository", {}).get("full_name", repository)
+    event_pr_number = (event or {}).get("pull_request", {}).get("number", pr_number)
+    print(f"Loading context for PR in repository {event_repository}")
+    with telemetry_span("context", "stage"):
+        try:
+            pr_details = load_pr_context(event_repository, event_pr_number, github_token, event)
+        except Exception as e:
+            print(f"Could not load PR context: {e}")
+            # Only run the step-by-step connection test when something went wrong
+            test_github_connection()
+            print("Exiting due to GitHub authentication/connection issues")
+            return
+    # The workspace only holds the PR in Actions; a server has no checkout of the event's PR
+    pr_details['has_checkout'] = event is None
+    print({key: value for key, value in pr_details.items() if key != 'github_token'})
+    record_pr_details(pr_details)
+
+    # Blocking GitHub calls run on their own bounded pool so they overlap with model requests
+    github_io = concurrent.futures.ThreadPoolExecutor(max_workers=config["github_io_workers"],
+                                                      thread_name_prefix="github-io")
+    pending_posts = []
+    streamed_poster = None
+    try:
+        get_pr_objects(pr_details)
+
+        # Index the comments of earlier runs, so that only new comments are posted
+        incremental = config["posting"]["incremental"] and not shard
+        if incremental:
+            try:
+                pr_details['posted_comments'] = await run_github_io(github_io, load_posted_comments, pr_details)
+            except Exception as e:
+                print(f"⚠️ Could not list earlier comments, posting all comments: {e}")
+
+        # Fetch the diff content
+        print("Fetching diff content...")
+        with telemetry_span("fetch", "stage"):
+            diff_text = await run_github_io(github_io, get_diff, pr_details)
+        record_run('diff', diff_text)
+        #print(diff_text)
+
+        # Parse the diff content
+        print("Parsing diff content...")
+        with telemetry_span("parse", "stage"):
+            position_index = {}
+            parsed_files = parse_diff(diff_text,
+                                      exclude_patterns=config["exclude"],
+                                      include_patterns=config["include"],
+                                      position_index=position_index)
+            parsed_files = split_oversized_chunks(parsed_files, config["windows"],
+                                                  get_backend_model(config["backends"]["default"]))
+        record_run('windows', parsed_files)
+        if not parsed_files:
+            print("No valid files to review found in the PR")
+            return
+        print(f"Found {len(parsed_files)} file chunks to review")
+
+        # Review repeated edits once
+        with telemetry_span("dedup", "stage"):
+            parsed_files = group_duplicate_chunks(parsed_files, config["dedup"])
+
+        # Fit the review into the budget before any model call is made. Every shard
+        # plans the whole PR the same way, so the budget holds for the PR as a whole
+        with telemetry_span("plan", "stage"):
+            roster = select_roster(config)
+            parsed_files, roster, budget_notice = apply_review_budget(parsed_files, roster, pr_details,
+                                                                      config,
+                                                                      get_backend_model(config["backends"]["default"]))
+
+        # Keep only this job's share of the chunks
+        if shard:
+            parsed_files = select_shard(parsed_files, shard)
+        if budget_notice and shard:
+            shard_notices.append(budget_notice)
+        elif budget_notice:
+            await run_github_io(github_io, post_notice, pr_details, budget_notice)
+        if not parsed_files:
+            if shard:
+                write_shard_results(shard_results_path, [], [], shard_notices)
+            return
+
+        # Review the most valuable chunks first, in case the budget runs out
+        parsed_files = prioritize_chunks(parsed_files, config)
+        schedule = config["schedule"]
+        # Shard jobs split the token budget of the PR between them
+        token_budget = schedule["token_budget"] and schedule["token_budget"] / (shard[1] if shard else 1)
+        deadline = None
+        if schedule["time_budget_minutes"]:
+            deadline = run_started + (schedule["time_budget_minutes"] - schedule["reserve_minutes"]) * 60
+        expected_chunk_seconds = len(roster) * config["budget"]["seconds_per_call"]
+        chunk_seconds = []
+        reviewed_scopes = set()
+        chunk_digests = []
+        tokens_used = 0
+        stop_reason = None
+        coalesce = config["coalesce"]
+        last_head_check = None
+        superseded = False
+
+        # Initialize review collections
+        inline_reviews = []
+        general_reviews = []
+        held_posts = []
+
+        # When coalescing, posts wait for the final head check; otherwise they overlap with the review
+        def queue_post(poster: Callable, *args: Any) -> None:
+            if coalesce["enabled"]:
+                held_posts.append((poster, args))
+            else:
+                pending_posts.append(asyncio.create_task(
+                    post_after(pending_posts[-1] if pending_posts else None, poster, *args)))
+
+        # Background posts go out one after another, so comments appear on the PR in chunk order
+        async def post_after(previous: Optional[asyncio.Task], poster: Callable, *args: Any) -> None:
+            if previous:
+                await asyncio.gather(previous, return_exceptions=True)
+            await run_github_io(github_io, poster, pr_details, *args)
+
+        # In streaming mode, inline comments are posted while the deities are still writing;
+        # shard jobs leave all posting to the merge job
+        streaming = config["streaming"]["enabled"] and not shard
+        streamed_reviews = []
+        streamed_queue = asyncio.Queue()
+        if streaming:
+            streamed_poster = asyncio.create_task(
+                post_streamed_comments(github_io, streamed_queue, pr_details, position_index, coalesce["enabled"]))
+
+        # Reviews of similar chunks from earlier runs
+        review_cache = get_review_cache(config)
+
+        # Terminology and links across the whole documentation
+        # Only indexed for the deities that use them, off the event loop so server workers keep running
+        roster_names = {deity["name"] for deity in roster}
+        docs_index = None
+        if roster_names & {"Demeter", "Heracles"} and pr_details['has_checkout']:
+            with telemetry_span("index docs", "stage"):
+                docs_index = await asyncio.to_thread(get_docs_index, config)
+        staleness_index = None
+        if "Chronos" in roster_names and pr_details['has_checkout']:
+            with telemetry_span("index history", "stage"):
+                staleness_index = await asyncio.to_thread(get_staleness_index, config, pr_details)
+
+        # Process each file for review
+        with telemetry_span("review", "stage"):
+            for chunk_number, file_data in enumerate(parsed_files):
+                file_path = file_data['to']
+                chunk = file_data['chunk']
+
+                # Stop reviewing a head that a newer push has replaced
+                if coalesce["enabled"] and (last_head_check is None or
+                                            time.monotonic() - last_head_check > coalesce["check_seconds"]):
+                    last_head_check = time.monotonic()
+                    superseded = await run_github_io(github_io, is_superseded, pr_details)
+                    if superseded:
+                        break
+
+                # Stop before a chunk that would not finish within the budget, and post what we have
+                if chunk_seconds:
+                    expected_chunk_seconds = sum(chunk_seconds) / len(chunk_seconds)
+                if deadline and time.monotonic() + expected_chunk_seconds > deadline:
+                    stop_reason = "time"
+                elif token_budget and chunk_number and \
+                        tokens_used + tokens_used / chunk_number > token_budget:
+                    stop_reason = "token"
+                if stop_reason:
+                    skipped_files = sorted({re.sub(r"^b/", "", skipped['to'])
+                                            for representative in parsed_files[chunk_number:]
+                                            for skipped in [representative] + representative.get('duplicates', [])})
+                    print(f"Stopping early: the {stop_reason} budget would be exceeded")
+                    stop_notice = (f"The review stopped after {chunk_number} of {len(parsed_files)} changed chunks "
+                                   f"because the {stop_reason} budget ran out. Chunks were reviewed most important "
+                                   f"first; chunks in {', '.join(skipped_files)} were not reviewed.")
+                    if shard:
+                        shard_notices.append(stop_notice)
+                    else:
+                        queue_post(post_notice, stop_notice)
+                    break
+
+                print(f"Reviewing file: {file_path}")
+
+                # Reuse earlier reviews of a similar chunk, and only summon the deities without one
+                chunk_roster = roster
+                cached_inline_reviews, cached_general_reviews = [], []
+                reviewed_deities = []
+                if review_cache:
+                    chunk_vector = embed_chunk(chunk)
+                    cache_entry = review_cache.lookup(chunk_vector)
+                    chunk_roster = []
+                    for deity in roster:
+                        cached = cache_entry and review_cache.get_reviews(
+                            cache_entry, deity["name"], deity_fingerprint(deity, config), file_path, chunk)
+                        if cached:
+                            cached_inline_reviews.extend(cached[0])
+                            cached_general_reviews.extend(cached[1])
+                            reviewed_deities.append(deity["name"])
+                        else:
+                            chunk_roster.append(deity)
+                    if len(chunk_roster) < len(roster):
+                        print(f"Reused {len(roster) - len(chunk_roster)} cached reviews of a similar chunk")
+
+                file_inline_reviews, file_general_reviews = [], []
+                if chunk_roster:
+                    # Define a termination condition that stops the task once every deity on the roster
+                    # has reported, with a hard cap on turns, or if the special phrase is mentioned
+                    text_termination = TextMentionTermination("DOCUMENTATION REVIEW COMPLETE")
+                    reviewers_reported = ReviewersReportedTermination(
+                        [deity["name"] for deity in chunk_roster],
+                        max_turns=len(chunk_roster) + config["termination"]["extra_turns"]
+                    )
+
+                    # Create a team of freshly summoned Greek gods and goddesses on the roster
+                    greek_pantheon_team = RoundRobinGroupChat(
+                        summon_pantheon(chunk_roster, config), 
+                        termination_condition=reviewers_reported | text_termination
+                    )
+
+                    # Create the task for each deity to perform
+                    task = build_review_task(pr_details, file_path, chunk, build_repository_context(
+                        docs_index, staleness_index, chunk_roster, file_path, chunk, config))
+
+                    # Run the review
+                    print(f"Starting review process with divine pantheon for {file_path}...")
+                    with telemetry_span(f"review {file_path}", "hunk", file=file_path, chunk=chunk['content']) as hunk_span:
+                        if streaming:
+                            divine_responses = await Console(stream_inline_reviews(
+                                greek_pantheon_team.run_stream(task=task), file_data, streamed_queue, streamed_reviews))
+                        else:
+                            divine_responses = await greek_pantheon_team.run(task=task)
+
+                        # Token usage travels with each message, whichever task made the model call
+                        usages = [message.models_usage for message in divine_responses.messages if message.models_usage]
+                        hunk_span['attributes']['prompt_tokens'] = sum(usage.prompt_tokens for usage in usages)
+                        hunk_span['attributes']['completion_tokens'] = sum(usage.completion_tokens for usage in usages)
+                    chunk_seconds.append(hunk_span['end'] - hunk_span['start'])
+                    replies = [message for message in divine_responses.messages
+                               if isinstance(message, BaseChatMessage) and isinstance(message.content, str)]
+                    record_run('chunks', {
+                        'file': file_path,
+                        'chunk': chunk['content'],
+                        'messages': [{'source': message.source, 'content': message.content} for message in replies],
+                    })
+                    tokens_used += sum(usage.prompt_tokens + usage.completion_tokens for usage in usages)
+
+                    # Parse responses into inline + general comments
+                    file_inline_reviews, file_general_reviews = parse_task_result_for_reviews(divine_responses)
+                    file_inline_reviews = drop_overlap_comments(chunk, file_inline_reviews)
+                    # Only deities that reported have reviewed the chunk again
+                    reporters = {message.source for message in replies if is_review_reply(message.content)}
+                    reviewed_deities.extend(deity["name"] for deity in chunk_roster if deity["name"] in reporters)
+
+                    # Remember each deity's review of this chunk for later runs
+                    if review_cache:
+                        review_cache.store(cache_entry, chunk_vector, chunk, {
+                            deity["name"]: {
+                                'fingerprint': deity_fingerprint(deity, config),
+                                'inline': [{'lineNumber': comment['lineNumber'], 'body': comment['body']}
+                                           for comment in file_inline_reviews if comment['deity'] == deity["name"]
+                                           and re.sub(r"^b/", "", comment['filename']) == re.sub(r"^b/", "", file_path)],
+                                'general': [comment['body'] for comment in file_general_reviews
+                                            if comment['deity'] == deity["name"]],
+                            }
+                            for deity in chunk_roster if deity["name"] in reporters
+                        })
+
+                if config["summary"]["enabled"] and not shard:
+                    chunk_digests.append(build_chunk_digest(
+                        file_data, cached_inline_reviews + file_inline_reviews,
+                        cached_general_reviews + file_general_reviews, config["summary"]))
+
+                # General comments are scoped to the first line the chunk reviews
+                overlap_lines = set(chunk.get('overlap_lines', ()))
+                scope_line = min((change['ln'] for change in chunk['changes'] if change['ln'] not in overlap_lines),
+                                 default=None)
+                file_inline_reviews, file_general_reviews = fan_out_duplicate_comments(
+                    file_data, cached_inline_reviews + file_inline_reviews,
+                    [dict(comment, scopeLine=scope_line) for comment in cached_general_reviews + file_general_reviews])
+                reviewed_scopes.update(chunk_scopes(file_data, reviewed_deities))
+
+                # Collect all reviews
+                inline_reviews.extend(file_inline_reviews)
+                general_reviews.extend(file_general_reviews)
+
+                # General comments are posted while the next chunk is being reviewed, unless held
+                if not shard:
+                    queue_post(post_general_comments, file_general_reviews)
+
+        if review_cache:
+            review_cache.save()
+
+        # Print the parsed results for debugging
+        print("\n Inline Comments:")
+        for comment in inline_reviews:
+            print(comment)
+        print("\n General Summary Comments:")
+        for comment in general_reviews:
+            print(comment)
+
+        # Reduce the chunk reviews to one summary of the whole PR
+        if chunk_digests:
+            with telemetry_span("summarize", "stage"):
+                pr_digest = await summarize_pull_request(chunk_digests, config)
+            reviewed_scopes.add((PR_SUMMARY_PATH, None, None, config["summary"]["deity"]))
+            queue_post(post_general_comments, [{
+                'deity': config["summary"]["deity"],
+                'filename': PR_SUMMARY_PATH,
+                'body': format_pr_summary(pr_digest),
+            }])
+
+        # Post nothing for a head that a newer push has replaced
+        if coalesce["enabled"] and not superseded:
+            superseded = await run_github_io(github_io, is_superseded, pr_details)
+        if superseded:
+            if streaming:
+                streamed_poster.cancel()
+            for task in pending_posts:
+                task.cancel()
+            await asyncio.gather(*pending_posts, *([streamed_poster] if streaming else []), return_exceptions=True)
+            return
+
+        # Shard jobs hand their comments to the merge job
+        if shard:
+            write_shard_results(shard_results_path, inline_reviews, general_reviews, shard_notices, reviewed_scopes)
+            return
+
+        # Post comments to GitHub PR; general and streamed comments are already on their way
+        print("Posting comments to GitHub PR...")
+        with telemetry_span("post", "stage"):
+            if streaming:
+                streamed_queue.put_nowait(None)
+                print(f"Streamed {await streamed_poster} inline comments while reviewing")
+            for poster, args in held_posts:
+                await run_github_io(github_io, poster, pr_details, *args)
+            remaining_reviews = [comment for comment in inline_reviews if comment not in streamed_reviews]
+            await run_github_io(github_io, post_comments_to_pr, pr_details, remaining_reviews, [], position_index)
+            await asyncio.gather(*pending_posts)
+            if incremental:
+                # Notices from earlier runs are stale unless this run posted them again
+                await run_github_io(github_io, minimize_stale_comments, pr_details, reviewed_scopes | {NOTICE_SCOPE})
+    finally:
+        # Nothing is left running when the review returns early or fails
+        if streamed_poster:
+            streamed_poster.cancel()
+        for task in pending_posts:
+            task.cancel()
+        github_io.shutdown()
+
+################
+# Review server
+################
+
+# Webhook signature checker
+def verify_webhook_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """Check GitHub's X-Hub-Signature-256 header against the payload and the shared secret."""
+    expected = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or "")
+
+# Reviewable event filter
+def is_reviewable_event(event: Dict[str, Any], config: Dict[str, Any]) -> bool:
+    """Tell whether a payload is a pull_request event with an action worth a review."""
+    return bool(event.get("pull_request")) and event.get("action", "opened") in config["server"]["actions"]
+
+# Event describer for logs
+def describe_event(event: Dict[str, Any]) -> str:
+    pull_request = event.get("pull_request") or {}
+    return (f"{(event.get('repository') or {}).get('full_name', repository)}#{pull_request.get('number')} "
+            f"at {(pull_request.get('head') or {}).get('sha', 'unknown')[:7]}")
+
+# Coalescing review queue
+class PullRequestEventQueue:
+    """
+    Bounded queue of PR events that keeps only the latest event of each PR.
+
+    A newer event for a PR that is still waiting replaces the older one in its
+    place in line, so a burst of pushes becomes one review of the latest head.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._events: Dict[Tuple[str, Any], Dict[str, Any]] = {}
+        self._keys: asyncio.Queue = asyncio.Queue()
+
+    def full(self) -> bool:
+        return len(self._events) >= self._maxsize
+
+    async def offer(self, event: Dict[str, Any]) -> bool:
+        """Queue an event for review, or refuse it when the queue is full."""
+        key = ((event.get("repository") or {}).get("full_name", repository), event["pull_request"].get("number"))
+        if key in self._events:
+            print(f"Coalesced queued review of {describe_event(self._events[key])} into {describe_event(event)}")
+            self._events[key] = event
+            return True
+        if self.full():
+            return False
+        self._events[key] = event
+        self._keys.put_nowait(key)
+        print(f"Queued review of {describe_event(event)}")
+        return True
+
+    async def get(self) -> Dict[str, Any]:
+        """Wait for the next PR to review and return its latest event."""
+        return self._events.pop(await self._keys.get())
+
+# Webhook endpoint
+def make_webhook_handler(loop: asyncio.AbstractEventLoop, queue: PullRequestEventQueue,
+                         config: Dict[str, Any]) -> type:
+    """Build an HTTP handler that verifies GitHub webhooks and queues pull request events."""
+    secret = os.environ.get(config["server"]["secret_env"])
+
+    class WebhookHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if secret and not verify_webhook_signature(secret, body, self.headers.get("X-Hub-Signature-256")):
+                self.send_error(401, "Invalid webhook signature")
+                return
+            try:
+                event = json.loads(body)
+            except ValueError:
+                self.send_error(400, "Payload is not JSON")
+                return
+
+            if self.headers.get("X-GitHub-Event") != "pull_request" or not is_reviewable_event(event, config):
+                self.send_response(204)
+                self.end_headers()
+                return
+
+            # The queue belongs to the event loop, so the event is handed over on its thread
+            queued = asyncio.run_coroutine_threadsafe(queue.offer(event), loop).result()
+            if not queued:
+                self.send_error(503, "Review queue is full")
+                return
+            self.send_response(202)
+            self.end_headers()
+
+        def log_message(self, format: str, *args: Any) -> None:
+            print(f"Webhook: {format % args}")
+
+    return WebhookHandler
+
+# Local event queue poller
+async def poll_event_directory(directory: str, queue: PullRequestEventQueue, config: Dict[str, Any]) -> None:
+    """
+    Queue the PR event payloads dropped into a directory as *.json files.
+
+    Files are read in name order and removed once queued; write them under
+    another name and rename them into place, so no half-written file is read.
+    """
+    os.makedirs(directory, exist_ok=True)
+    while True:
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            # Leave the rest on disk until the workers catch up
+            if queue.full():
+                break
+            path = os.path.join(directory, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    event = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Skipping unreadable event file {path}: {e}")
+                os.replace(path, f"{path}.invalid")
+                continue
+            os.remove(path)
+            if is_reviewable_event(event, config):
+                await queue.offer(event)
+        await asyncio.sleep(config["server"]["poll_seconds"])
+
+# Review worker
+async def review_worker(name: str, queue: PullRequestEventQueue, config: Dict[str, Any]) -> None:
+    """Review queued PR events one at a time, for as long as the server runs."""
+    while True:
+        event = await queue.get()
+        # Each review collects its own telemetry and writes it to files named after the PR and head,
+        # so concurrent reviews neither mix their spans nor overwrite each other's files
+        telemetry = new_telemetry()
+        token = current_telemetry.set(telemetry)
+        pull_request = event.get("pull_request") or {}
+        try:
+            print(f"{name}: reviewing {describe_event(event)}")
+            await review_pull_request(config, event=event)
+        except Exception as e:
+            print(f"⚠️ {name}: review of {describe_event(event)} failed: {e}")
+        finally:
+            current_telemetry.reset(token)
+            export_telemetry(config, telemetry,
+                             f"pr{pull_request.get('number')}-{(pull_request.get('head') or {}).get('sha', 'unknown')[:7]}")
+
+# Review server
+async def serve(config: Dict[str, Any], address: Optional[str], queue_directory: Optional[str]) -> None:
+    """
+    Review PR events as they arrive, from GitHub webhooks and/or a local queue directory.
+
+    The process stays resident, so imports, model clients with their HTTP pools,
+    GitHub clients and caches are set up once rather than on every event.
+    A fixed pool of workers bounds how many PRs are reviewed at once.
+    """
+    server_config = config["server"]
+    queue = PullRequestEventQueue(server_config["queue_size"])
+    tasks = [asyncio.create_task(review_worker(f"worker-{i + 1}", queue, config))
+             for i in range(server_config["workers"])]
+
+    httpd = None
+    if address:
+        host, _, port = address.rpartition(":")
+        httpd = http.server.ThreadingHTTPServer((host or "0.0.0.0", int(port)),
+                                                make_webhook_handler(asyncio.get_running_loop(), queue, config))
+        threading.Thread(target=httpd.serve_forever, name="webhook-server", daemon=True).start()
+        print(f"Listening for GitHub webhooks on {host or '0.0.0.0'}:{port}")
+        if not os.environ.get(server_config["secret_env"]):
+            print(f"⚠️ {server_config['secret_env']} is not set; webhook signatures are not verified")
+    if config["docs_index"]["enabled"] or config["staleness"]["enabled"]:
+        print("⚠️ The documentation and staleness indexes need a checkout of the PR, so they are off in server mode")
+    if queue_directory:
+        tasks.append(asyncio.create_task(poll_event_directory(queue_directory, queue, config)))
+        print(f"Watching {queue_directory} for PR events")
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if httpd:
+            httpd.shutdown()
+
 # Main function to run the GitHub Action
 async def main() -> None:
-
-    # Test Github connection
-    if not test_github_connection():
-        print("Exiting due to GitHub authentication/connection issues")
+    global model_clients
+
+    parser = argparse.ArgumentParser(description="Review a pull request with the divine pantheon.")
+    parser.add_argument("--record", metavar="ARCHIVE",
+                        help="record the run to this file (overrides recording.path)")
+    parser.add_argument("--replay", metavar="ARCHIVE",
+                        help="re-run parsing and posting from a recorded run against a local fake GitHub")
+    parser.add_argument("--shard", metavar="INDEX/COUNT", type=parse_shard,
+                        help="review only this shard of the PR's files and write the comments instead of posting them")
+    parser.add_argument("--shard-results", metavar="FILE",
+                        help="where a shard writes its comments (default: pantheon-shard-INDEX.jsonl)")
+    parser.add_argument("--merge", metavar="FILE", nargs="+",
+                        help="post the comments written by every shard, as one review")
+    parser.add_argument("--serve", metavar="[HOST:]PORT",
+                        help="stay resident and review the PRs of incoming GitHub webhooks")
+    parser.add_argument("--queue-dir", metavar="DIR",
+                        help="stay resident and review the PR event payloads dropped into this directory")
+    args = parser.parse_args()
+
+    # Replay a recorded run offline, printing the GitHub writes it makes
+    if args.replay:
+        print(json.dumps(replay_recording(args.replay), indent=2))
         return
 
-    # Fetch the PR content
-    print(f"Fetching content for PR #{pr_number} in repository {repository}")
-    pr_details = get_pr_details(repository, pr_number, github_token)
-    print(pr_details)
+    # Load the review configuration
+    config = load_config()
 
-    # Fetch the diff content
-    print("Fetching diff content...")
-    diff_text = get_diff(pr_details)
-    #print(diff_text)
-    
-    # Parse the diff content
-    print("Parsing diff content...")
-    parsed_files = parse_diff(diff_text, exclude_patterns=["*.mdx", "*.py", "*.lock"])
-    if not parsed_files:
-        print("No valid files to review found in the PR")
+    # Post the comments of a sharded review
+    if args.merge:
+        merge_shard_results(config, args.merge)
         return
-    print(f"Found {len(parsed_files)} file chunks to review")
-    
-    # Process each file for review
-    for file_data in parsed_files:
-        file_path = file_data['to']
-        chunk = file_data['chunk']
-        
-        # Format changes for display
-        changes_text = ""
-        for change in chunk['changes']:
-            changes_text += f"{change['content']}\n"
-            
-        print(f"Reviewing file: {file_path}")
-
-        # Define a termination condition that stops the task if a special phrase is mentioned
-        text_termination = TextMentionTermination("DOCUMENTATION REVIEW COMPLETE")
-
-        # Create a team with all the Greek gods and goddesses
-        greek_pantheon_team = RoundRobinGroupChat(
-            [apollo, hermes, athena, hestia, mnemosyne, hephaestus, heracles, demeter, aphrodite, iris, dionysus, chronos, atropos], 
-            termination_condition=text_termination
-        )
-
-        # Create the task for each deity to perform
-        task = f"""Your task is to review the following changes from pull requests according to your divine domain of expertise. Instructions:
-        - Respond in the following JSON format:
-        {{
-        "inlineReviews": [
-            {{
-            "filename": "{file_path}",
-            "position": <position>,  // This is the line number in the unified diff view (starts at 1)
-            "reviewComment": "[ReviewType] Poignant and actionable line-specific feedback. Brief reasoning."
-            }}
-        ],
-        "generalReviews": [
-            {{
-            "filename": "{file_path}",
-            "reviewComment": "Respective personality-based summary of content review. SCORE: [0-100] "
-            }}
-        ]
-        }}
-        - The `position` is NOT the original file line number.
-        - The `position` is the line index (1-based) within the diff block itself.
-        - Create a reasonable amount of inlineReview comments (in the JSON format above) as necessary to improve the content without overwhelming the original author who will review the comments.
-        - Create one general summary comment reflective of your divine personality that summarized the overall content review (in the JSON format above).
-        - Do NOT wrap the output in triple backticks. DO NOT use markdown formatting like ```json.
-        - Do NOT include explanations or extra commentary.
-        - All comments should reflect your unique personality and domain.
-        - Do NOT give positive comments or compliments.
-        - Write the comment in GitHub Markdown format.
-        - IMPORTANT: NEVER suggest adding comments to the code.
-
-        Review the following code diff in the file "{file_path}".
-
-        Pull request title: {pr_details['title']}
-        Pull request description:
-
-        ---
-        {pr_details['description']}
-        ---
-
-        Git diff to review:
-
-        ```diff
-        {chunk['content']}
-        {changes_text}
-        ```
-
-        Your feedback should be specific, constructive, and actionable.
-        """
 
-        # Initialize review collections
-        inline_reviews = []
-        general_reviews = []
+    model_clients = create_model_clients(config)
+
+    # Stay resident and review PR events as they arrive
+    if args.serve or args.queue_dir:
+        try:
+            await serve(config, args.serve, args.queue_dir)
+        finally:
+            for client in model_clients.values():
+                await client.close()
+        return
 
-        # Run the review
-        print(f"Starting review process with divine pantheon for {file_path}...")
-        divine_responses = await greek_pantheon_team.run(task=task)
+    record_path = args.record or config["recording"]["path"]
+    if record_path:
+        start_recording(config)
 
-        # Parse responses into inline + general comments
-        file_inline_reviews, file_general_reviews = parse_task_result_for_reviews(divine_responses)
-        
-        # Collect all reviews
-        if 'file_path' not in locals():
-            inline_reviews = file_inline_reviews
-            general_reviews = file_general_reviews
-        else:
-            inline_reviews.extend(file_inline_reviews)
-            general_reviews.extend(file_general_reviews)
-
-    # Print the parsed results for debugging
-    print("\n Inline Comments:")
-    for comment in inline_reviews:
-        print(comment)
-    print("\n General Summary Comments:")
-    for comment in general_reviews:
-        print(comment)
-
-    # Post comments to GitHub PR
-    print("Posting comments to GitHub PR...")
-    post_comments_to_pr(repository, pr_number, github_token, inline_reviews, general_reviews)
+    try:
+        await review_pull_request(config, shard=args.shard,
+                                  shard_results_path=args.shard_results or
+                                  f"pantheon-shard-{args.shard[0] if args.shard else 0}.jsonl")
+    finally:
+        # Report where the time, tokens and money went, even when the run failed
+        export_telemetry(config)
+        if record_path:
+            save_recording(record_path)
     
+    # Report how much of the prompt was served from the provider's cache
+    prompt_cache_stats = current_telemetry.get()['prompt_cache']
+    prompt_tokens = prompt_cache_stats["prompt_tokens"]
+    cached_tokens = prompt_cache_stats["cached_tokens"]
+    cache_hit_rate = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    print(f"Prompt cache: {cached_tokens} of {prompt_tokens} prompt tokens served from cache ({cache_hit_rate:.0%})")
+
     # Print completion message
     print("Documentation review process completed!")
 
-    # Close the connection to the model client
-    await model_client.close()
+    # Close the connections to the model backends
+    for client in model_clients.values():
+        await client.close()
 
     
 # Entry point for the GitHub Action